@@ -0,0 +1,58 @@
+"""Benchmark del loader: execute_values vs COPY + merge sobre la tabla contacts.
+
+Mide tres pasadas: filas nuevas, filas modificadas y filas idénticas (row_hash sin cambios).
+
+Uso (con las variables PG_* del .env apuntando a una base de pruebas):
+    python -m benchmarks.bench_loader --rows 200000
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from utils.db_utils import db_connection, init_schema, init_contacts_table
+from utils.sync_utils import upsert_rows
+
+SCHEMA = "bench_loader"
+COLUMNS = ["hs_object_id", "firstname", "lastname", "email", "phone", "createdate", "lastmodifieddate"]
+UPDATE_COLUMNS = ["firstname", "lastname", "email", "phone", "lastmodifieddate"]
+
+
+def make_rows(n, version):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        (i, f"Nombre {i}", f"Apellido {version}", f"user{i}@example.com", "+56 9 1234 5678",
+         base + timedelta(minutes=i), base + timedelta(minutes=i, days=version))
+        for i in range(1, n + 1)
+    ]
+
+
+def run(loader, rows):
+    results = {}
+    with db_connection(SCHEMA) as conn, conn.cursor() as cursor:
+        cursor.execute("TRUNCATE contacts;")
+        conn.commit()
+
+        for phase, version in (("insert", 0), ("update", 1), ("unchanged", 1)):
+            data = make_rows(rows, version)
+            start = time.perf_counter()
+            upsert_rows(cursor, "contacts", COLUMNS, UPDATE_COLUMNS, data, schema=SCHEMA, mode=loader)
+            conn.commit()
+            results[phase] = rows / (time.perf_counter() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    init_schema(SCHEMA)
+    init_contacts_table(SCHEMA)
+
+    print(f"{'loader':<8} {'insert rows/s':>14} {'update rows/s':>14} {'unchanged rows/s':>17}")
+    for loader in ("values", "copy"):
+        r = run(loader, args.rows)
+        print(f"{loader:<8} {r['insert']:>14,.0f} {r['update']:>14,.0f} {r['unchanged']:>17,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Presupuesto de arranque de main.py medido con `python -X importtime`.
+
+Importa main en un proceso nuevo varias veces, toma el mejor tiempo acumulado y falla
+(código de salida 1) si supera el presupuesto o si el import arrastra módulos que una
+corrida programada no usa (SDK de HubSpot, asyncio/aiohttp, multiprocessing, http.server).
+Sirve como chequeo en CI o antes de subir cambios a los imports.
+
+Uso:
+    python -m benchmarks.bench_startup --budget-ms 150 --runs 5
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "150"))
+# Módulos que solo deben cargarse en el modo que los usa
+LAZY_MODULES = ("hubspot", "asyncio", "aiohttp", "multiprocessing", "http.server", "pandas")
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(module="main"):
+    """Corre un import en frío y devuelve [(módulo, propio_us, acumulado_us, nivel)]."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if result.returncode:
+        raise SystemExit(f"❌ Falló `import {module}`:\n{result.stderr}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            rows.append((name, int(own), int(cumulative), len(indent) // 2))
+    # Solo el árbol de `module` (importtime lista los hijos antes que el padre); lo previo es de site
+    end = next(i for i, row in enumerate(rows) if row[0] == module and row[3] == 0)
+    start = max((i + 1 for i, row in enumerate(rows[:end]) if row[3] == 0), default=0)
+    return rows[start:end + 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    # El mejor de varios imports en frío: descarta el ruido de la máquina
+    best = min((measure(args.module) for _ in range(args.runs)), key=lambda rows: rows[-1][2])
+    total_ms = best[-1][2] / 1000
+
+    print(f"⏱️ import {args.module}: {total_ms:.1f} ms (mejor de {args.runs}; presupuesto {args.budget_ms:.0f} ms)")
+    print("Módulos directos más lentos (acumulado):")
+    direct = sorted((r for r in best if r[3] == 1), key=lambda r: -r[2])
+    for name, _, cumulative, _ in direct[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failures = []
+    loaded = {name for name, *_ in best}
+    eager = sorted(m for m in loaded if m.split(".")[0] in LAZY_MODULES or m in LAZY_MODULES)
+    if eager:
+        failures.append(f"módulos que deberían importarse en el primer uso: {', '.join(eager[:10])}")
+    if total_ms > args.budget_ms:
+        failures.append(f"{total_ms:.1f} ms supera el presupuesto de {args.budget_ms:.0f} ms")
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        return 1
+    print("✅ Arranque dentro del presupuesto")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Benchmark de la sincronización completa contra un HubSpot falso y un PostgreSQL local.
+
+Corre main.main() con get_hubspot_client apuntando a benchmarks.fake_hubspot. Cada entidad
+se sincroniza en un proceso propio para medir su pico de RSS por separado. Reporta
+registros/s, llamadas a la API, tiempo de "red" (dentro del cliente falso) y de base de
+datos (etapas transform y db_write de utils.metrics) y el RSS máximo.
+
+Escribe en el schema "hubspot" de la base configurada en PG_*: úsese una base de pruebas.
+
+Uso:
+    python -m benchmarks.bench_sync --contacts 50000 --deals 20000 --emails 100000 --latency 0.05
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+# Sin esto el token bucket (9 req/s por defecto) domina cualquier medición local
+os.environ.setdefault("HUBSPOT_RATE_PER_SECOND", "1000")
+os.environ.setdefault("HUBSPOT_SEARCH_RATE_PER_SECOND", "1000")
+
+
+def run_entity(entity, volumes, latency, error_rate):
+    """Sincroniza una entidad en este proceso y devuelve sus métricas."""
+    import main
+    import utils.hubspot_utils as hubspot_utils
+    from utils import metrics
+    from benchmarks.fake_hubspot import FakeHubSpot
+
+    client = FakeHubSpot(volumes, latency=latency, error_rate=error_rate)
+    hubspot_utils.get_hubspot_client = lambda *args, **kwargs: client
+
+    start = time.perf_counter()
+    results = main.main(["--full", "--entities", entity])
+    wall = time.perf_counter() - start
+    stages = [data["stages"] for data in metrics.snapshot().values()]
+    db_time = sum(s[stage]["seconds"] for s in stages for stage in ("transform", "db_write") if stage in s)
+
+    records = {name: sum(stats.values()) for name, stats in results.items()}
+    return {
+        "entity": entity,
+        "records": records,
+        "wall": wall,
+        "api_calls": sum(client.calls.values()),
+        "network": sum(client.network_time.values()),
+        "db": db_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--contacts", type=int, default=20000)
+    parser.add_argument("--deals", type=int, default=5000)
+    parser.add_argument("--emails", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Segundos por llamada a la API.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Proporción de llamadas que responden 429.")
+    args = parser.parse_args()
+
+    volumes = {"contacts": args.contacts, "deals": args.deals, "emails": args.emails}
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for entity in ("contacts", "deals", "engagements"):
+        with context.Pool(1) as pool:
+            rows.append(pool.apply(run_entity, (entity, volumes, args.latency, args.error_rate)))
+
+    print(f"\n{'entidad':<12} {'registros':>10} {'rec/s':>9} {'llamadas':>9} "
+          f"{'red (s)':>8} {'db (s)':>7} {'total (s)':>9} {'RSS MB':>7}")
+    for r in rows:
+        total = sum(r["records"].values())
+        detail = " + ".join(f"{n}={c}" for n, c in r["records"].items())
+        print(f"{r['entity']:<12} {total:>10} {total / r['wall']:>9,.0f} {r['api_calls']:>9} "
+              f"{r['network']:>8.2f} {r['db']:>7.2f} {r['wall']:>9.2f} {r['peak_rss_mb']:>7.0f}  ({detail})")
+
+
+if __name__ == "__main__":
+    main()
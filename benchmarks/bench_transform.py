@@ -0,0 +1,113 @@
+"""Microbenchmark de la transformación registros -> filas (sin red ni base de datos).
+
+Compara la comprensión fila a fila original de save_*_to_db con el extractor compilado
+por entidad (sync_utils.compile_extractor).
+
+Uso:
+    python -m benchmarks.bench_transform --rows 200000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from utils.entities import DEALS, ENGAGEMENTS
+from utils.sync_utils import compile_extractor, parse_date
+
+
+def make_deals(n):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    days = [(base + timedelta(days=d)).strftime("%Y-%m-%dT00:00:00Z") for d in range(365)]
+    return [
+        SimpleNamespace(id=str(i), properties={
+            "hs_object_id": str(i),
+            "dealname": f"Deal {i}",
+            "dealstage": random.choice(["appointmentscheduled", "closedwon", "closedlost"]),
+            "pipeline": "default",
+            "amount": f"{random.uniform(100, 10000):.2f}" if i % 4 else None,
+            "closedate": random.choice(days),
+            "createdate": (base + timedelta(seconds=i * 37)).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "lastmodifieddate": random.choice(days),
+        })
+        for i in range(1, n + 1)
+    ]
+
+
+def make_emails(n):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        SimpleNamespace(id=str(i), properties={
+            "hs_object_id": str(i),
+            "hs_email_direction": random.choice(["INCOMING_EMAIL", "EMAIL"]),
+            "hs_timestamp": (base + timedelta(minutes=i // 3)).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "hs_from_email": f"user{i % 500}@example.com",
+            "hs_to_email": "ventas@example.com",
+            "hs_subject": f"Re: cotización {i}",
+        })
+        for i in range(1, n + 1)
+    ]
+
+
+def legacy_deals(deals):
+    """Comprensión original de save_deals_to_db."""
+    return [
+        (
+            int(d.properties.get("hs_object_id")),
+            d.properties.get("dealname"),
+            d.properties.get("dealstage"),
+            d.properties.get("pipeline"),
+            float(d.properties.get("amount")) if d.properties.get("amount") else None,
+            parse_date(d.properties.get("closedate")),
+            parse_date(d.properties.get("createdate")),
+            parse_date(d.properties.get("lastmodifieddate")),
+        )
+        for d in deals
+        if d.properties.get("hs_object_id")
+    ]
+
+
+def legacy_emails(engagements):
+    """Comprensión original de save_engagements_to_db."""
+    return [
+        (
+            int(e.properties.get("hs_object_id")),
+            e.properties.get("hs_email_direction"),
+            parse_date(e.properties.get("hs_timestamp")),
+            e.properties.get("hs_from_email"),
+            e.properties.get("hs_to_email"),
+            e.properties.get("hs_subject"),
+        )
+        for e in engagements
+        if e.properties.get("hs_object_id")
+    ]
+
+
+def timed(fn, records, repeat):
+    """Mejor tasa (registros/s) de `repeat` corridas."""
+    best, rows = 0.0, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = fn(records)
+        best = max(best, len(records) / (time.perf_counter() - start))
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'entidad':<12} {'original rows/s':>16} {'compilado rows/s':>17} {'mejora':>7}")
+    for entity, records, legacy in (
+        (DEALS, make_deals(args.rows), legacy_deals),
+        (ENGAGEMENTS, make_emails(args.rows), legacy_emails),
+    ):
+        expected, legacy_rate = timed(legacy, records, args.repeat)
+        rows, rate = timed(compile_extractor(entity), records, args.repeat)
+        assert rows == expected, f"{entity.name}: el extractor compilado no coincide con el original"
+        print(f"{entity.name:<12} {legacy_rate:>16,.0f} {rate:>17,.0f} {rate / legacy_rate:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Cliente HubSpot falso para benchmarks offline.
+
+Implementa la parte de `client.crm` que usa hubspot_utils (objects.search_api.do_search,
+objects.batch_api.read, objects.basic_api.get_page, associations.v4.batch_api.get_page y
+properties.core_api.get_all) sobre registros sintéticos
+generados a partir del ID, así que no guarda millones de objetos en memoria. Respeta los
+límites reales de la API (100 resultados por página, tope de 10.000 por búsqueda, 100 IDs
+por batch read, 1.000 por batch de asociaciones) y permite inyectar latencia, respuestas 429
+y objetos archivados.
+"""
+import operator
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from hubspot.crm.objects import ApiException
+
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+STAGES = ["appointmentscheduled", "qualifiedtobuy", "closedwon", "closedlost"]
+LIFECYCLE = ["subscriber", "lead", "marketingqualifiedlead", "opportunity", "customer"]
+ASSOCIATION_PAGE_SIZE = 500   # asociaciones por objeto de origen y página (v4)
+OPERATORS = {"EQ": operator.eq, "GT": operator.gt, "GTE": operator.ge, "LT": operator.lt, "LTE": operator.le}
+
+
+def _iso(dt):
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def make_properties(object_type, i):
+    """Propiedades deterministas del objeto `i` de un tipo."""
+    created = BASE_DATE + timedelta(minutes=i)
+    modified = _iso(created + timedelta(days=i % 30))
+    if object_type == "contacts":
+        return {
+            "hs_object_id": str(i), "firstname": f"Nombre{i}", "lastname": f"Apellido{i % 997}",
+            "email": f"contacto{i}@example.com", "phone": f"+56 9 {i:08d}" if i % 5 else None,
+            "lifecyclestage": LIFECYCLE[i % len(LIFECYCLE)], "createdate": _iso(created),
+            "lastmodifieddate": modified, "hs_lead_status": "NEW" if i % 3 else None,
+            "score_interno": str(i % 100),
+        }
+    if object_type == "deals":
+        return {
+            "hs_object_id": str(i), "dealname": f"Negocio {i}", "dealstage": STAGES[i % len(STAGES)],
+            "pipeline": "default", "amount": f"{(i * 7919) % 100000 / 10:.2f}" if i % 4 else None,
+            "closedate": _iso(BASE_DATE + timedelta(days=i % 365)), "createdate": _iso(created),
+            "lastmodifieddate": modified, "hs_lastmodifieddate": modified,
+            "hs_priority": ["low", "medium", "high"][i % 3],
+        }
+    return {
+        "hs_object_id": str(i), "hs_email_direction": "INCOMING_EMAIL" if i % 2 else "EMAIL",
+        "hs_timestamp": _iso(created), "hs_from_email": f"contacto{i % 5000}@example.com",
+        "hs_to_email": "ventas@example.com", "hs_subject": f"Re: cotización #{i}\tpendiente",
+        "hs_lastmodifieddate": modified,
+    }
+
+
+def make_associations(object_type, i, to_total):
+    """IDs de contactos asociados al objeto `i` (deals: 1 a 3 contactos, emails: el remitente)."""
+    if not to_total:
+        return []
+    if object_type == "emails":
+        return [i % 5000 % to_total + 1]
+    return sorted({(i * k * 7919) % to_total + 1 for k in range(1, i % 3 + 2)})
+
+
+def _field(obj, name, attr):
+    return obj[name] if isinstance(obj, dict) else getattr(obj, attr)
+
+
+def _to_number(prop, value):
+    if prop == "hs_object_id":
+        return int(value)
+    if prop.endswith("date") or prop == "hs_timestamp":
+        if str(value).isdigit():    # los filtros de fecha llegan en epoch ms
+            return int(value)
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000
+    return value
+
+
+class FakeHubSpot:
+    """Stand-in de `HubSpot` con volúmenes, latencia y tasa de 429 configurables."""
+
+    def __init__(self, volumes, latency=0.0, error_rate=0.0, seed=42, archived=None):
+        self.volumes = volumes
+        self.archived = {t: set(ids) for t, ids in (archived or {}).items()}   # fuera de búsquedas y lecturas
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = defaultdict(int)            # (object_type, operación) -> llamadas
+        self.network_time = defaultdict(float)   # object_type -> segundos dentro de la "API"
+        self._random = random.Random(seed)
+        self._totals = {}
+        self._lock = threading.Lock()
+        objects = SimpleNamespace(
+            search_api=SimpleNamespace(do_search=self.do_search),
+            batch_api=SimpleNamespace(read=self.read),
+            basic_api=SimpleNamespace(get_page=self.get_page),
+        )
+        associations = SimpleNamespace(v4=SimpleNamespace(batch_api=SimpleNamespace(get_page=self.get_associations)))
+        properties = SimpleNamespace(core_api=SimpleNamespace(get_all=self.get_properties))
+        self.crm = SimpleNamespace(objects=objects, associations=associations, properties=properties)
+
+    def _call(self, object_type, operation):
+        start = time.perf_counter()
+        with self._lock:
+            self.calls[(object_type, operation)] += 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.network_time[object_type] += time.perf_counter() - start
+        if fail:
+            error = ApiException(status=429, reason="Too Many Requests")
+            error.headers = {"Retry-After": "1"}
+            raise error
+
+    def _matches(self, object_type, i, filters):
+        if i in self.archived.get(object_type, ()):
+            return False
+        props = None
+        for f in filters:
+            prop = _field(f, "propertyName", "property_name")
+            compare = OPERATORS[_field(f, "operator", "operator")]
+            if prop == "hs_object_id":
+                actual = i
+            else:
+                props = props or make_properties(object_type, i)
+                if props.get(prop) is None:
+                    return False
+                actual = _to_number(prop, props[prop])
+            if not compare(actual, _to_number(prop, _field(f, "value", "value"))):
+                return False
+        return True
+
+    def do_search(self, object_type, public_object_search_request, **kwargs):
+        request = public_object_search_request
+        self._call(object_type, "search")
+        limit = request.limit or 10
+        after = int(request.after or 0)
+        if limit > 200 or after + limit > 10000:
+            raise ApiException(status=400, reason="La búsqueda excede el límite de 10.000 resultados")
+
+        filters = [f for group in (request.filter_groups or []) for f in _field(group, "filters", "filters")]
+        start, end = self._id_bounds(object_type, filters)
+        descending = any(_field(s, "direction", "direction") == "DESCENDING" for s in request.sorts or [])
+        candidates = range(end, start - 1, -1) if descending else range(start, end + 1)
+        skipped, ids = 0, []
+        for i in candidates:
+            if len(ids) > limit:
+                break
+            if self._matches(object_type, i, filters):
+                if skipped < after:
+                    skipped += 1
+                else:
+                    ids.append(i)
+
+        has_more = len(ids) > limit
+        results = [SimpleNamespace(id=str(i), properties={"hs_object_id": str(i)}) for i in ids[:limit]]
+        paging = SimpleNamespace(next=SimpleNamespace(after=str(after + limit))) if has_more else None
+        return SimpleNamespace(results=results, paging=paging, total=self._total(object_type, start, end, filters))
+
+    def _id_bounds(self, object_type, filters):
+        """Rango de IDs a recorrer según los filtros sobre hs_object_id."""
+        start, end = 1, self.volumes.get(object_type, 0)
+        for f in filters:
+            if _field(f, "propertyName", "property_name") != "hs_object_id":
+                continue
+            op, value = _field(f, "operator", "operator"), int(_field(f, "value", "value"))
+            if op in ("GT", "GTE"):
+                start = max(start, value + (op == "GT"))
+            elif op in ("LT", "LTE"):
+                end = min(end, value - (op == "LT"))
+        return start, end
+
+    def _total(self, object_type, start, end, filters):
+        """Coincidencias de la búsqueda completa (cacheado: las páginas siguientes repiten filtros)."""
+        key = (object_type, start, end, repr(filters))
+        with self._lock:
+            if key in self._totals:
+                return self._totals[key]
+        count = sum(1 for i in range(start, end + 1) if self._matches(object_type, i, filters))
+        with self._lock:
+            self._totals[key] = count
+        return count
+
+    def read(self, object_type, batch_read_input_simple_public_object_id, archived=False):
+        # Misma firma que BatchApi.read del SDK: las propiedades van dentro del input
+        inputs = batch_read_input_simple_public_object_id.inputs
+        properties = batch_read_input_simple_public_object_id.properties
+        self._call(object_type, "batch_read")
+        if len(inputs) > 100:
+            raise ApiException(status=400, reason="Batch read admite como máximo 100 inputs")
+        results = []
+        for item in inputs:
+            oid = int(_field(item, "id", "id"))
+            if 1 <= oid <= self.volumes.get(object_type, 0) and oid not in self.archived.get(object_type, ()):
+                props = make_properties(object_type, oid)
+                results.append(SimpleNamespace(id=str(oid), properties={p: props.get(p) for p in properties or []}))
+        return SimpleNamespace(results=results)
+
+    def get_page(self, object_type, limit=10, after=None, properties=None, archived=False, **kwargs):
+        self._call(object_type, "list")
+        after = int(after or 0)
+        if archived:
+            ids = sorted(self.archived.get(object_type, ()))[after:after + limit + 1]
+        else:
+            ids = [i for i in range(after + 1, self.volumes.get(object_type, 0) + 1)
+                   if i not in self.archived.get(object_type, ())][:limit + 1]
+        archived_at = BASE_DATE + timedelta(days=400) if archived else None
+        results = [SimpleNamespace(id=str(i), archived=archived, archived_at=archived_at,
+                                   properties={"hs_object_id": str(i)}) for i in ids[:limit]]
+        has_more = len(ids) > limit
+        next_after = after + limit if archived else (ids[limit - 1] if has_more else None)
+        paging = SimpleNamespace(next=SimpleNamespace(after=str(next_after))) if has_more else None
+        return SimpleNamespace(results=results, paging=paging)
+
+    def get_properties(self, object_type, archived=False, **kwargs):
+        self._call(object_type, "properties")
+        return SimpleNamespace(results=[SimpleNamespace(name=name) for name in make_properties(object_type, 1)])
+
+    def get_associations(self, from_object_type, to_object_type, batch_input_public_fetch_associations_batch_request, **kwargs):
+        inputs = batch_input_public_fetch_associations_batch_request.inputs
+        self._call(from_object_type, "associations")
+        if len(inputs) > 1000:
+            raise ApiException(status=400, reason="El batch de asociaciones admite como máximo 1.000 inputs")
+        type_id = 3 if from_object_type == "deals" else 198
+        results = []
+        for item in inputs:
+            oid = int(_field(item, "id", "id"))
+            after = int((item.get("after") if isinstance(item, dict) else item.after) or 0)
+            if not 1 <= oid <= self.volumes.get(from_object_type, 0):
+                continue
+            to_ids = make_associations(from_object_type, oid, self.volumes.get(to_object_type, 0))
+            page = to_ids[after:after + ASSOCIATION_PAGE_SIZE]
+            if not page:
+                continue
+            more = after + ASSOCIATION_PAGE_SIZE < len(to_ids)
+            results.append(SimpleNamespace(
+                _from=SimpleNamespace(id=str(oid)),
+                to=[SimpleNamespace(to_object_id=str(to_id),
+                                    association_types=[SimpleNamespace(category="HUBSPOT_DEFINED", type_id=type_id, label=None)])
+                    for to_id in page],
+                paging=SimpleNamespace(next=SimpleNamespace(after=str(after + ASSOCIATION_PAGE_SIZE))) if more else None,
+            ))
+        return SimpleNamespace(results=results)
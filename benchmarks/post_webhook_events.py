@@ -0,0 +1,47 @@
+"""Envía eventos de webhook de ejemplo al servicio local (python main.py --serve).
+
+Si HUBSPOT_WEBHOOK_SECRET está definido, firma el request como HubSpot (v3).
+
+Uso:
+    python -m benchmarks.post_webhook_events --url http://127.0.0.1:8080/webhooks
+    python -m benchmarks.post_webhook_events --file mis_eventos.json
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import urllib.request
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "webhook_events.json")
+
+
+def post_events(url, events, secret=None):
+    body = json.dumps(events).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        timestamp = str(int(time.time() * 1000))
+        message = f"POST{url}".encode("utf-8") + body + timestamp.encode("utf-8")
+        signature = base64.b64encode(hmac.new(secret.encode("utf-8"), message, hashlib.sha256).digest()).decode()
+        headers.update({"X-HubSpot-Request-Timestamp": timestamp, "X-HubSpot-Signature-v3": signature})
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    with urllib.request.urlopen(request) as response:
+        return response.status, json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhooks")
+    parser.add_argument("--file", default=FIXTURE)
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        events = json.load(f)
+    status, payload = post_events(args.url, events, os.getenv("HUBSPOT_WEBHOOK_SECRET"))
+    print(f"{status}: {payload}")
+
+
+if __name__ == "__main__":
+    main()
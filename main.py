@@ -1,42 +1,259 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from itertools import chain, zip_longest
+from utils import metrics
+from utils.batch_utils import batch_sizes, log_batch_sizes
+from utils.entities import ENTITIES, derived_entities, get_entity, root_entities
 from utils.hubspot_utils import (
-    get_contacts_batch, get_deals_batch, get_leads_batch, get_engagements_batch
+    HUBSPOT_BACKEND, get_archived_pages, get_associations, get_entity_batch, get_id_pages, get_portal, get_portals,
+    get_records_by_id
 )
+from utils.cache_utils import RAW_CACHE, cache_key, evict_cache, replay_pages
 from utils.sync_utils import (
-    save_contacts_to_db, save_deals_to_db, save_leads_to_db, save_engagements_to_db
-)
-from utils.db_utils import (
-    init_schema, init_contacts_table, init_deals_table, init_leads_table, init_engagements_table
+    format_stats, reconcile_archived, reconcile_full, replay_entity, save_associations_to_db, save_chunk,
+    save_entity_to_db, sync_entity
 )
+from utils.db_utils import close_all_pools, init_entity_table, init_schema
+from utils.report_utils import init_report_tables, refresh_summaries
+from utils.state_db_utils import shard_key
+from utils.logger import logger
+
+# hubspot_async_utils (asyncio/aiohttp), parallel_utils (multiprocessing) y webhook_utils (http.server)
+# se importan solo en el modo que los usa: una corrida programada no paga su arranque
+
+# Trabajos (portal, entidad raíz) sincronizándose a la vez; se toman en round-robin entre portales
+SYNC_MAX_JOBS = int(os.getenv("SYNC_MAX_JOBS", "8"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sincroniza HubSpot con PostgreSQL.")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignora los watermarks de sync_status y descarga todo el CRM.")
+    parser.add_argument("--entities", default=None,
+                        help="Entidades a sincronizar separadas por coma (por defecto, todas).")
+    parser.add_argument("--portals", default=None,
+                        help="Portales a sincronizar separados por coma (por defecto, todos los de "
+                             "HUBSPOT_PORTALS o el de HUBSPOT_TOKEN).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Procesos de sincronización; con más de 1, las entidades grandes se "
+                             "reparten por rangos de hs_object_id.")
+    parser.add_argument("--reconcile", choices=["archived", "full"], default=None,
+                        help="En vez de sincronizar, marca archived_at en los registros archivados o "
+                             "borrados en HubSpot: 'archived' usa el listado de archivados, 'full' "
+                             "compara todos los IDs vivos con la base.")
+    parser.add_argument("--replay", action="store_true",
+                        help="Rehace las tablas desde el cache local de páginas crudas (RAW_CACHE=1), "
+                             "sin llamar a la API.")
+    parser.add_argument("--serve", action="store_true",
+                        help="Servicio continuo: recibe webhooks de HubSpot y sincroniza los objetos "
+                             "que cambian en segundos.")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Puerto del endpoint de webhooks (con --serve; por defecto WEBHOOK_PORT o 8080).")
+    return parser.parse_args(argv)
+
+
+def derived_sinks(name, portal=None):
+    """Sinks que salen del stream de una entidad raíz: sus derivadas y sus asociaciones."""
+    entity = get_entity(name)
+    # Las derivadas (p. ej. leads) salen del stream de su entidad de origen
+    derived = [(d.name, d.matches, partial(save_entity_to_db, d.name)) for d in derived_entities(name)]
+    if entity.associations:
+        # Las asociaciones se releen para los objetos que trae esta corrida
+        derived.append((f"{name}_associations", None,
+                        partial(save_associations_to_db, name, fetch=partial(get_associations, portal=portal))))
+    return derived
+
+
+def sync_job(name, full=False, id_range=None, update_watermarks=True, portal=None):
+    """Sincroniza una entidad raíz de un portal (o un rango de IDs de ella) junto con sus derivadas
+    y asociaciones, en el schema del portal. `portal` es su nombre, así el trabajo se puede mandar
+    a otro proceso (modo --workers)."""
+    portal = get_portal(portal)
+    derived = derived_sinks(name, portal)
+    fetch_batch = get_entity_batch
+    if HUBSPOT_BACKEND == "async":
+        from utils.hubspot_async_utils import get_entity_batch_async
+        fetch_batch = get_entity_batch_async
+    try:
+        return sync_entity(
+            name, partial(fetch_batch, name, id_range=id_range, portal=portal), partial(save_entity_to_db, name),
+            schema=portal.schema, full=full, derived=derived, update_watermarks=update_watermarks,
+            shard=shard_key(id_range),
+        )
+    finally:
+        # Los bloques ya confirmados cuentan aunque la corrida se corte
+        refresh_summaries({name} | {d.name for d in derived_entities(name)}, portal.schema)
+
+
+def fair_order(jobs_by_portal):
+    """Intercala los trabajos de cada portal en round-robin: el 1.º de cada portal, luego el 2.º, etc.
+
+    Con SYNC_MAX_JOBS en vuelo, un portal con muchas entidades (o muy grandes) no ocupa todos
+    los lugares antes de que arranquen los demás.
+    """
+    return [job for job in chain.from_iterable(zip_longest(*jobs_by_portal)) if job is not None]
+
+
+def flush_events(pending, schema="hubspot", portal=None):
+    """Escribe los objetos de los webhooks: batch read + upsert de los cambiados y archived_at
+    para los borrados (o los que el batch read ya no devuelve)."""
+    now = datetime.now(timezone.utc)
+    for name, objects in pending.items():
+        names = {name} | {d.name for d in derived_entities(name)}
+        upserts = [oid for oid, kind in objects.items() if kind == "upsert"]
+        records = get_records_by_id(name, upserts, portal) if upserts else []
+        found = {str(r.id) for r in records}
+        deleted = [oid for oid in objects if oid not in found]
+        try:
+            if records:
+                sinks = [(name, None, partial(save_entity_to_db, name))] + derived_sinks(name, portal)
+                totals = {sink: {"inserted": 0, "updated": 0, "unchanged": 0} for sink, _, _ in sinks}
+                save_chunk(sinks, records, totals, schema)
+            if deleted:
+                reconcile_archived(sorted(names), [[(int(oid), now) for oid in deleted]], schema)
+        finally:
+            refresh_summaries(names, schema)
+        logger.info(f"🌐 {name}: {len(records)} objetos actualizados y {len(deleted)} archivados por webhooks")
 
-def main():
+
+def replay_job(name, schema="hubspot"):
+    """Reprocesa una entidad raíz y sus derivadas desde el cache crudo (las asociaciones no se cachean)."""
+    # Las páginas del cache pueden ser anteriores a un --reconcile: no reviven filas archivadas
+    derived = [(d.name, d.matches, partial(save_entity_to_db, d.name, restore_archived=False))
+               for d in derived_entities(name)]
+    try:
+        return replay_entity(name, replay_pages(cache_key(name, schema)),
+                             partial(save_entity_to_db, name, restore_archived=False),
+                             schema=schema, derived=derived)
+    finally:
+        refresh_summaries({name} | {d.name for d in derived_entities(name)}, schema)
+
+
+def reconcile(mode, roots, schema="hubspot", portal=None):
+    """Reconciliación de archivados/borrados de las entidades raíz y sus derivadas."""
+    results = {}
+    for entity in roots:
+        names = [entity.name] + [d.name for d in derived_entities(entity.name)]
+        try:
+            if mode == "archived":
+                results.update(reconcile_archived(names, get_archived_pages(entity.name, portal=portal), schema))
+            else:
+                for name in names:
+                    results[name] = reconcile_full(name, get_id_pages(name, portal=portal), schema)
+        except Exception as e:
+            logger.error(f"❌ Error reconciliando {entity.name}: {e}")
+            print(f"❌ Error en {entity.name}: {e}")
+    # Archivar o restaurar filas cambia los reportes de esas tablas
+    changed = {name for name, stats in results.items() if any(stats.values())}
+    refresh_summaries(changed, schema, rebuild=True)
+    prefix = "" if schema == "hubspot" else f"{schema}."
+    for name, stats in results.items():
+        print(f"🗃️ {prefix}{name}: " + ", ".join(f"{count} {key}" for key, count in stats.items()))
+    return results
+
+
+def main(argv=None):
+    """Corre la sincronización y devuelve los conteos por entidad (con varios portales, por portal y entidad)."""
+    args = parse_args(argv)
+    metrics.reset()
+    selected = set(args.entities.split(",")) if args.entities else None
+    portals = get_portals()
+    if args.portals:
+        portals = [get_portal(name) for name in args.portals.split(",")]
+    multi = len(portals) > 1
     print("🧱 Verificando estructura...")
-    init_schema("hubspot")
-    init_contacts_table("hubspot")
-    init_deals_table("hubspot")
-    init_leads_table("hubspot")
-    init_engagements_table("hubspot")
-
-    # CONTACTOS
-    print("\n📇 Descargando contactos (Batch Read)...")
-    contacts = get_contacts_batch(limit=10000)
-    save_contacts_to_db(contacts)
-
-    # DEALS
-    print("\n💼 Descargando deals (Batch Read)...")
-    deals = get_deals_batch(limit=10000)
-    save_deals_to_db(deals)
-
-    # LEADS
-    print("\n👥 Descargando leads (Batch Read)...")
-    leads = get_leads_batch(limit=10000)
-    save_leads_to_db(leads)
-
-    # ENGAGEMENTS
-    print("\n📩 Descargando engagements (Batch Read)...")
-    emails = get_engagements_batch(limit=10000)
-    save_engagements_to_db(emails)
+    for portal in portals:
+        init_schema(portal.schema)
+        for name in ENTITIES:
+            init_entity_table(name, portal.schema)
+        init_report_tables(portal.schema)
+
+    roots = [e for e in root_entities() if selected is None or e.name in selected]
+    by_portal = {portal.name: {} for portal in portals}
+
+    def label(portal, name):
+        return f"{portal.name}/{name}" if multi else name
+
+    def finish(**extra):
+        close_all_pools()
+        log_batch_sizes()
+        results = by_portal if multi else by_portal[portals[0].name]
+        metrics.write_run_report(extra={**extra, "portals": [p.name for p in portals], "results": results,
+                                        "batch_sizes": batch_sizes()})
+        return results
+
+    if args.serve:
+        # Los webhooks de una app llegan de un portal por proceso: con varios se corre uno por portal
+        if multi:
+            raise SystemExit("--serve atiende un solo portal; elegilo con --portals")
+        from utils.webhook_utils import WEBHOOK_PORT, WebhookService
+        portal = portals[0]
+        flush = partial(flush_events, schema=portal.schema, portal=portal)
+        WebhookService(flush, port=args.port or WEBHOOK_PORT).serve_forever()
+        finish(serve=True)
+        return {}
+
+    if args.reconcile:
+        for portal in portals:
+            by_portal[portal.name] = reconcile(args.reconcile, roots, portal.schema, portal)
+        return finish(reconcile=args.reconcile)
+
+    if args.replay:
+        for portal in portals:
+            for entity in roots:
+                print(f"\n{entity.icon} Reprocesando {label(portal, entity.label)} desde el cache...")
+                try:
+                    for name, stats in replay_job(entity.name, portal.schema).items():
+                        by_portal[portal.name][name] = stats
+                        print(f"📊 {label(portal, name)}: {format_stats(stats)}")
+                except Exception as e:
+                    logger.error(f"❌ Error reprocesando {label(portal, entity.name)}: {e}")
+                    print(f"❌ Error en {label(portal, entity.name)}: {e}")
+        return finish(replay=True)
+
+    for entity in roots:
+        labels = " y ".join([entity.label] + [d.label for d in derived_entities(entity.name)])
+        print(f"\n{entity.icon} Descargando {labels} (Batch Read)...")
+
+    if args.workers > 1:
+        # Un proceso por shard; cada uno con su parte del rate limit de cada portal. Los portales
+        # se reparten los procesos de a uno por vez
+        from utils.parallel_utils import run_sharded
+        for portal in portals:
+            job = partial(sync_job, portal=portal.name)
+            results, errors = run_sharded(job, roots, full=args.full, workers=args.workers,
+                                          schema=portal.schema, portal=portal.name)
+            by_portal[portal.name].update(results)
+            for name, stats in results.items():
+                print(f"📊 {label(portal, name)}: {format_stats(stats)}")
+            for entity, shard_errors in errors.items():
+                print(f"❌ Error en {label(portal, entity)}: {'; '.join(shard_errors)}")
+    else:
+        # Cada (portal, entidad) corre en un hilo con el rate limit de su portal; la base la
+        # comparten todos a través del pool único de db_utils
+        jobs = fair_order([[(portal, entity.name) for entity in roots] for portal in portals])
+        with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), SYNC_MAX_JOBS))) as executor:
+            futures = {
+                executor.submit(sync_job, entity, full=args.full, portal=portal): (portal, entity)
+                for portal, entity in jobs
+            }
+            for future, (portal, entity) in futures.items():
+                try:
+                    for name, stats in future.result().items():
+                        by_portal[portal.name][name] = stats
+                        print(f"📊 {label(portal, name)}: {format_stats(stats)}")
+                except Exception as e:
+                    logger.error(f"❌ Error sincronizando {label(portal, entity)}: {e}")
+                    print(f"❌ Error en {label(portal, entity)}: {e}")
 
+    if RAW_CACHE:
+        evict_cache()
+    results = finish()
     print("\n✅ Sincronización completa con Batch Read.")
+    return results
 
 if __name__ == "__main__":
     main()
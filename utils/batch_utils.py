@@ -0,0 +1,117 @@
+import os
+import threading
+from utils import metrics
+from utils.logger import logger
+
+# Objetivos del escritor de PostgreSQL por lote: memoria del buffer (COPY o VALUES) y duración
+DB_BATCH_MAX_MB = float(os.getenv("DB_BATCH_MAX_MB", "16"))
+DB_BATCH_TARGET_SECONDS = float(os.getenv("DB_BATCH_TARGET_SECONDS", "2"))
+DB_BATCH_MIN_ROWS = int(os.getenv("DB_BATCH_MIN_ROWS", "500"))
+DB_BATCH_MAX_ROWS = int(os.getenv("DB_BATCH_MAX_ROWS", "50000"))
+# Tamaño del primer lote de una tabla, antes de tener mediciones
+DB_BATCH_INITIAL_ROWS = int(os.getenv("DB_BATCH_INITIAL_ROWS", "10000"))
+# Peso de la última medición en los promedios móviles
+DB_BATCH_SMOOTHING = 0.3
+
+
+class BatchSizer:
+    """Tamaño de lote adaptativo para una tabla, a partir de los bytes por fila y los segundos
+    por fila observados en los lotes anteriores.
+
+    El lote es el mayor que cumple a la vez max_mb y target_seconds, dentro de [min_rows,
+    max_rows]; entre un lote y el siguiente a lo sumo se duplica, así una medición rápida
+    aislada no dispara un lote enorme. Thread-safe: la comparten los hilos que escriben la tabla.
+    """
+
+    def __init__(self, table=None, max_mb=DB_BATCH_MAX_MB, target_seconds=DB_BATCH_TARGET_SECONDS,
+                 min_rows=DB_BATCH_MIN_ROWS, max_rows=DB_BATCH_MAX_ROWS, initial_rows=DB_BATCH_INITIAL_ROWS):
+        self.table = table
+        self.max_bytes = max_mb * 1024 * 1024
+        self.target_seconds = target_seconds
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.bytes_per_row = None
+        self.seconds_per_row = None
+        self._size = max(min_rows, min(max_rows, initial_rows))
+        self._batches = self._rows = self._min = self._max = 0
+        self._lock = threading.Lock()
+
+    def size(self):
+        """Filas del próximo lote."""
+        with self._lock:
+            return self._size
+
+    def observe(self, rows, nbytes, seconds):
+        """Registra un lote escrito (filas, bytes enviados, segundos) y recalcula el tamaño."""
+        if not rows:
+            return
+        with self._lock:
+            self._batches += 1
+            self._rows += rows
+            self._min = min(self._min or rows, rows)
+            self._max = max(self._max, rows)
+            self.bytes_per_row = self._smooth(self.bytes_per_row, nbytes / rows)
+            # En lotes chicos (p. ej. un incremental de pocas filas) pesa el costo fijo del round-trip
+            if rows >= self.min_rows or seconds > self.target_seconds:
+                self.seconds_per_row = self._smooth(self.seconds_per_row, seconds / rows)
+            size = min(self.max_rows, self._size * 2)
+            if self.bytes_per_row:
+                size = min(size, self.max_bytes / self.bytes_per_row)
+            if self.seconds_per_row:
+                size = min(size, self.target_seconds / self.seconds_per_row)
+            self._size = max(self.min_rows, int(size))
+        if self.table:
+            metrics.incr(self.table, "db_batches")
+            metrics.incr(self.table, "db_batch_rows", rows)
+            metrics.incr(self.table, "db_batch_bytes", nbytes)
+            metrics.observe(self.table, "db_batch", seconds)
+
+    @staticmethod
+    def _smooth(current, value):
+        return value if current is None else current + DB_BATCH_SMOOTHING * (value - current)
+
+    def summary(self):
+        """Lotes escritos, tamaños elegidos y promedios observados (para el log y el reporte)."""
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "min_rows": self._min,
+                "max_rows": self._max,
+                "avg_rows": round(self._rows / self._batches) if self._batches else 0,
+                "next_rows": self._size,
+                "bytes_per_row": round(self.bytes_per_row or 0, 1),
+                "ms_per_1000_rows": round(self.seconds_per_row * 1_000_000, 1) if self.seconds_per_row else None,
+            }
+
+
+_sizers = {}
+_sizers_lock = threading.Lock()
+
+
+def batch_sizer(table, schema="hubspot"):
+    """BatchSizer de una tabla, compartido por todo el proceso (aprende entre bloques y corridas)."""
+    with _sizers_lock:
+        sizer = _sizers.get((schema, table))
+        if sizer is None:
+            sizer = _sizers[(schema, table)] = BatchSizer(table)
+        return sizer
+
+
+def batch_sizes():
+    """Resumen por "schema.tabla" de los tamaños de lote elegidos en este proceso."""
+    with _sizers_lock:
+        sizers = dict(_sizers)
+    return {f"{schema}.{table}": sizer.summary() for (schema, table), sizer in sorted(sizers.items())}
+
+
+def log_batch_sizes():
+    """Deja en el log los tamaños de lote elegidos por tabla, para ajustar la base."""
+    sizes = batch_sizes()
+    for table, summary in sizes.items():
+        if summary["batches"]:
+            logger.info(
+                f"📦 Lotes de {table}: {summary['batches']} de {summary['min_rows']}-{summary['max_rows']} filas "
+                f"(promedio {summary['avg_rows']}, próximo {summary['next_rows']}), "
+                f"{summary['bytes_per_row']} bytes/fila, {summary['ms_per_1000_rows']} ms/1000 filas"
+            )
+    return sizes
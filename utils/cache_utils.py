@@ -0,0 +1,178 @@
+import gzip
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from utils.entities import Record
+from utils.logger import logger
+
+# Cache local de las páginas crudas descargadas de HubSpot, para rehacer las tablas con --replay
+RAW_CACHE = os.getenv("RAW_CACHE", "0") == "1"
+RAW_CACHE_DIR = os.getenv("RAW_CACHE_DIR", "data/raw_cache")
+RAW_CACHE_MAX_MB = float(os.getenv("RAW_CACHE_MAX_MB", "2048"))
+RAW_CACHE_MAX_AGE_DAYS = float(os.getenv("RAW_CACHE_MAX_AGE_DAYS", "30"))
+# Metadatos de cada corrida (inicio y `since`), para verificar que las incrementales se encadenan
+RUN_META = "run.json"
+
+
+class CacheGapError(Exception):
+    """El cache de una entidad no tiene una cadena completa de corridas para reproducir."""
+
+
+def cache_key(entity, schema="hubspot"):
+    """Carpeta de una entidad en el cache: la entidad o, fuera del schema "hubspot", <schema>.<entidad>
+    (cada portal sincroniza en su schema y no debe mezclar páginas con otro)."""
+    return entity if schema == "hubspot" else f"{schema}.{entity}"
+
+
+def run_dir(entity, started, full, root=RAW_CACHE_DIR):
+    """Carpeta de una corrida: <entidad>/<inicio UTC>-full|incremental (los shards comparten inicio)."""
+    kind = "full" if full else "incremental"
+    return os.path.join(root, entity, f"{started.strftime('%Y%m%dT%H%M%SZ')}-{kind}")
+
+
+def _write_meta(directory, started, since):
+    try:
+        with open(os.path.join(directory, RUN_META), "x", encoding="utf-8") as f:
+            json.dump({"started": started.isoformat(), "since": since.isoformat() if since else None}, f)
+    except FileExistsError:
+        pass   # otro shard de la misma corrida, o una corrida retomada: mismos valores
+
+
+def _read_meta(run):
+    try:
+        with open(os.path.join(run, RUN_META), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None   # corrida anterior a los metadatos o cortada al escribirlos
+    return {key: datetime.fromisoformat(value) if value else None for key, value in meta.items()}
+
+
+def cache_pages(entity, pages, started, since=None, shard="all", root=RAW_CACHE_DIR):
+    """Escribe cada página en <corrida>/<shard>.ndjson.gz a medida que pasa y la entrega sin cambios.
+
+    `since` es el de la descarga (None en una completa). Una corrida retomada agrega al mismo
+    archivo (gzip admite varios miembros); los registros repetidos se resuelven en el upsert del replay.
+    """
+    directory = run_dir(entity, started, since is None, root)
+    os.makedirs(directory, exist_ok=True)
+    _write_meta(directory, started, since)
+    path = os.path.join(directory, f"{shard}.ndjson.gz")
+    # Compresión baja: el gzip corre en el hilo de descarga y no debe frenarlo
+    try:
+        with gzip.open(path, "at", encoding="utf-8", compresslevel=1) as f:
+            for page in pages:
+                f.writelines(
+                    json.dumps({"id": r.id, "properties": r.properties}, ensure_ascii=False) + "\n" for r in page
+                )
+                f.flush()
+                yield page
+    finally:
+        close = getattr(pages, "close", None)
+        if close:
+            close()
+
+
+def _runs(entity, root=RAW_CACHE_DIR):
+    directory = os.path.join(root, entity)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory))
+
+
+def _latest_full(runs):
+    full = [run for run in runs if run.endswith("-full")]
+    return full[-1] if full else None
+
+
+def _chains(runs):
+    """Agrupa corridas ordenadas en cadenas: una completa y las incrementales que le siguen
+    (las incrementales anteriores a toda completa quedan en una cadena sin base)."""
+    chains = []
+    for run in runs:
+        if run.endswith("-full") or not chains:
+            chains.append([])
+        chains[-1].append(run)
+    return chains
+
+
+def replay_runs(entity, root=RAW_CACHE_DIR):
+    """Corridas a reproducir de una entidad: la última completa y las incrementales posteriores.
+
+    Falla con CacheGapError si no hay completa o si a la cadena le falta una corrida (una
+    incremental cuyo `since` es posterior al inicio de la corrida anterior en el cache): reproducir
+    con un hueco dejaría en la tabla valores más viejos que los que ya tiene.
+    """
+    runs = _runs(entity, root)
+    base = _latest_full(runs)
+    if base is None:
+        if runs:
+            raise CacheGapError(f"{entity}: el cache no tiene una corrida completa")
+        return runs
+    chain = runs[runs.index(base):]
+    for previous, run in zip(chain, chain[1:]):
+        before, meta = _read_meta(previous), _read_meta(run)
+        if before and meta and meta["since"] and meta["since"] > before["started"]:
+            raise CacheGapError(
+                f"{entity}: falta una corrida entre {os.path.basename(previous)} y {os.path.basename(run)} "
+                f"(desde {meta['since'].isoformat()}); hace falta una sincronización --full con RAW_CACHE=1"
+            )
+    return chain
+
+
+def replay_pages(entity, page_size=1000, root=RAW_CACHE_DIR):
+    """Genera páginas de Record desde el cache, de la corrida más vieja a la más nueva."""
+    for run in replay_runs(entity, root):
+        logger.info(f"📼 {entity}: reproduciendo {os.path.basename(run)}")
+        for name in sorted(n for n in os.listdir(run) if n.endswith(".ndjson.gz")):
+            page = []
+            with gzip.open(os.path.join(run, name), "rt", encoding="utf-8") as f:
+                try:
+                    for line in f:
+                        data = json.loads(line)
+                        page.append(Record(data["id"], data["properties"]))
+                        if len(page) >= page_size:
+                            yield page
+                            page = []
+                except (EOFError, json.JSONDecodeError):
+                    # Archivo de una corrida cortada a mitad de escritura: vale lo leído hasta ahí
+                    logger.warning(f"⚠️ {run}/{name} está truncado; se usa hasta el último registro completo")
+            if page:
+                yield page
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def evict_cache(root=RAW_CACHE_DIR, max_mb=RAW_CACHE_MAX_MB, max_age_days=RAW_CACHE_MAX_AGE_DAYS):
+    """Borra cadenas viejas (una completa con sus incrementales, siempre enteras): las que no tienen
+    corridas de los últimos max_age_days y, de la más vieja a la más nueva, hasta quedar bajo max_mb.
+    La cadena de la última completa de cada entidad se conserva entera (es la que usa el replay).
+    """
+    if not os.path.isdir(root):
+        return []
+    chains = []
+    for entity in os.listdir(root):
+        entity_runs = _runs(entity, root)
+        latest = _latest_full(entity_runs)
+        for chain in _chains(entity_runs):
+            if latest not in chain:
+                chains.append((max(os.path.getmtime(run) for run in chain), sum(_size(run) for run in chain), chain))
+            else:
+                chains.append((float("inf"), sum(_size(run) for run in chain), None))
+    chains.sort(key=lambda c: c[0])
+    total = sum(size for _, size, _ in chains)
+    cutoff = time.time() - max_age_days * 86400
+    removed = []
+    for mtime, size, chain in chains:
+        if chain is None or (mtime >= cutoff and total <= max_mb * 1024 * 1024):
+            continue
+        for run in chain:
+            shutil.rmtree(run, ignore_errors=True)
+        total -= size
+        removed.extend(chain)
+    if removed:
+        logger.info(f"🧹 Cache crudo: {len(removed)} corrida(s) eliminada(s), quedan {total / 1024 / 1024:.1f} MB")
+    return removed
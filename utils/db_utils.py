@@ -1,40 +1,103 @@
 import psycopg2
 import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
 from dotenv import load_dotenv
+from psycopg2.pool import ThreadedConnectionPool
+from utils.entities import get_entity
 from utils.logger import logger
 
 load_dotenv()
 
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+# Segundos de inactividad tras los cuales una conexión se valida con SELECT 1 antes de prestarla
+PG_POOL_CHECK_SECONDS = float(os.getenv("PG_POOL_CHECK_SECONDS", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_used = {}
+_search_paths = {}      # conexión -> schema fijado con SET search_path
+
 
 def init_sync_status_table(schema="hubspot"):
     """Crea la tabla de control de sincronización incremental."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
     query = """
     CREATE TABLE IF NOT EXISTS sync_status (
         entity VARCHAR(50) PRIMARY KEY,
         last_sync TIMESTAMP
     );
     """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute(query)
+        conn.commit()
     logger.info("✅ Tabla 'sync_status' verificada o creada.")
 
 
+def init_checkpoints_table(schema="hubspot"):
+    """Crea la tabla de checkpoints: hasta qué hs_object_id llegó cada shard de una corrida en curso."""
+    query = """
+    CREATE TABLE IF NOT EXISTS sync_checkpoints (
+        entity VARCHAR(50),
+        shard VARCHAR(50),
+        last_id BIGINT,
+        since TIMESTAMP,
+        started_at TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (entity, shard)
+    );
+    """
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute(query)
+        conn.commit()
+    logger.info("✅ Tabla 'sync_checkpoints' verificada o creada.")
+
+
+def init_associations_table(schema="hubspot"):
+    """Crea la tabla de asociaciones entre objetos (una fila por par y tipo de asociación)."""
+    query = """
+    CREATE TABLE IF NOT EXISTS associations (
+        id BIGSERIAL PRIMARY KEY,
+        from_type VARCHAR(50) NOT NULL,
+        from_id BIGINT NOT NULL,
+        to_type VARCHAR(50) NOT NULL,
+        to_id BIGINT NOT NULL,
+        type_id INTEGER NOT NULL,
+        category VARCHAR(30),
+        label VARCHAR(255),
+        row_hash CHAR(32),
+        UNIQUE (from_type, from_id, to_type, to_id, type_id)
+    );
+    CREATE INDEX IF NOT EXISTS associations_to_idx ON associations (to_type, to_id);
+    """
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute(query)
+        migrate_column_types(cursor, "associations", [("id", "BIGINT"), ("from_id", "BIGINT"), ("to_id", "BIGINT")])
+        conn.commit()
+    logger.info("✅ Tabla 'associations' verificada o creada.")
+
+
+def _connect_kwargs(schema=None):
+    return dict(
+        host=os.getenv("PG_HOST"),
+        port=os.getenv("PG_PORT"),
+        database=os.getenv("PG_DB"),
+        user=os.getenv("PG_USER"),
+        password=os.getenv("PG_PASSWORD"),
+        client_encoding="utf8",
+        options=f"-c search_path={schema}" if schema else ""
+    )
+
+
 def get_db_connection(schema: str = None):
-    """Conecta a PostgreSQL y, si se pasa schema, lo define como search_path."""
+    """Conecta a PostgreSQL y, si se pasa schema, lo define como search_path.
+
+    Abre una conexión dedicada; el código de sincronización usa db_connection (pool).
+    """
     try:
-        schema_option = f"-c search_path={schema}" if schema else ""
-        conn = psycopg2.connect(
-            host=os.getenv("PG_HOST"),
-            port=os.getenv("PG_PORT"),
-            database=os.getenv("PG_DB"),
-            user=os.getenv("PG_USER"),
-            password=os.getenv("PG_PASSWORD"),
-            options=schema_option
-        )
+        conn = psycopg2.connect(**_connect_kwargs(schema))
         logger.info(f"✅ Conexión exitosa (schema activo: {schema or 'public'})")
         return conn
     except Exception as e:
@@ -42,122 +105,326 @@ def get_db_connection(schema: str = None):
         return None
 
 
-def init_schema(schema="hubspot"):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema};")
+def get_pool():
+    """Devuelve el pool del proceso, compartido por todos los schemas (portales).
+
+    PG_POOL_MAX es el tope de conexiones del proceso entero: con varios portales no se
+    abre un pool por schema, cada préstamo fija el search_path que necesita.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, **_connect_kwargs())
+            # ThreadedConnectionPool falla si se agota; el semáforo hace que el checkout espere
+            _pool = (pool, threading.BoundedSemaphore(PG_POOL_MAX))
+            logger.info(f"✅ Pool de conexiones creado (min={PG_POOL_MIN}, max={PG_POOL_MAX})")
+        return _pool
+
+
+def _is_healthy(conn):
+    """Valida una conexión que estuvo inactiva más de PG_POOL_CHECK_SECONDS."""
+    if conn.closed:
+        return False
+    last_used = _last_used.get(conn)
+    if last_used is None or time.monotonic() - last_used < PG_POOL_CHECK_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _discard(pool, conn):
+    _last_used.pop(conn, None)
+    _search_paths.pop(conn, None)
+    pool.putconn(conn, close=True)
+
+
+def _use_schema(conn, schema):
+    """Fija el search_path de la conexión si la última vez se usó con otro schema (un round-trip)."""
+    if _search_paths.get(conn) == schema:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET search_path TO {schema};")
     conn.commit()
-    cursor.close()
-    conn.close()
+    _search_paths[conn] = schema
+
+
+@contextmanager
+def db_connection(schema: str = None):
+    """Presta una conexión del pool con search_path en `schema` y la devuelve al salir (rollback si hubo error)."""
+    pool, slots = get_pool()
+    slots.acquire()
+    try:
+        for _ in range(PG_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _is_healthy(conn):
+                break
+            logger.warning("⚠️ Conexión caída descartada del pool")
+            _discard(pool, conn)
+        else:
+            raise psycopg2.OperationalError("No se pudo obtener una conexión válida del pool")
+        try:
+            _use_schema(conn, schema or "public")
+        except psycopg2.Error:
+            _discard(pool, conn)
+            raise
+
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn.closed:
+                _discard(pool, conn)
+            else:
+                _last_used[conn] = time.monotonic()
+                pool.putconn(conn)
+    finally:
+        slots.release()
+
+
+def close_all_pools():
+    """Cierra todas las conexiones del pool del proceso."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool[0].closeall()
+        _pool = None
+        _last_used.clear()
+        _search_paths.clear()
+
+
+def init_schema(schema="hubspot"):
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema};")
+        conn.commit()
     logger.info(f"✅ Esquema '{schema}' verificado o creado.")
     init_sync_status_table(schema)
+    init_checkpoints_table(schema)
+    init_associations_table(schema)
+
+
+# Tipos que cambiaron respecto de versiones anteriores: tipo nuevo -> (data_type, expresión USING)
+_TYPE_MIGRATIONS = {
+    # Las fechas se guardaban en TIMESTAMP sin zona, en UTC
+    "TIMESTAMPTZ": ("timestamp with time zone", "{col} AT TIME ZONE 'UTC'"),
+    "BIGINT": ("bigint", "{col}::bigint"),
+}
+
+_partitions = set()
+_partitions_lock = threading.Lock()
+
+
+def entity_columns(entity):
+    """(columna, tipo) de la tabla de una entidad, incluidas las que agrega el sync."""
+    return [("id", "BIGINT")] + [(c.name, c.sql_type) for c in entity.columns] + [
+        ("extra", "JSONB"), ("row_hash", "CHAR(32)"), ("archived_at", "TIMESTAMPTZ"),
+    ]
+
+
+def entity_ddl(entity, existing=None):
+    """DDL idempotente de la tabla de una entidad. `existing` son las columnas de la tabla ya creada
+    (None si no existe): solo se agregan con ALTER las que faltan, porque cada ALTER toma un lock
+    exclusivo sobre la tabla aunque la columna ya exista.
+
+    extra guarda, como JSONB, las propiedades configuradas que no tienen columna propia
+    (ver entities.extra_property_setting). archived_at marca las filas archivadas o borradas
+    en HubSpot (ver --reconcile). Con partition_by la tabla se particiona por rango de esa
+    fecha (una partición por mes, más una default) y su clave única incluye la columna de partición.
+    """
+    table, partition_by = entity.table, entity.partition_by
+    keys = [f"PRIMARY KEY (id, {partition_by})"] if partition_by else []
+    alters = [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {sql_type};"
+        for name, sql_type in entity_columns(entity)[1:]
+        if existing is not None and name not in existing and name not in entity.conflict_columns
+    ]
+    return "\n".join([
+        f"CREATE TABLE IF NOT EXISTS {table} (",
+        f"    id BIGSERIAL{'' if partition_by else ' PRIMARY KEY'},",
+        *(f"    {c.name} {c.sql_type}," for c in entity.columns),
+        "    extra JSONB,",
+        "    row_hash CHAR(32),",
+        "    archived_at TIMESTAMPTZ,",
+        *(f"    {key}," for key in keys),
+        f"    UNIQUE ({entity.conflict_target})",
+        f"){f' PARTITION BY RANGE ({partition_by})' if partition_by else ''};",
+        *([f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;"] if partition_by else []),
+        *alters,
+    ])
+
+
+def _relkind(cursor, table):
+    """'r' tabla común, 'p' particionada, None si no existe (en el search_path)."""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _current_types(cursor, table):
+    cursor.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s;
+    """, (table,))
+    return dict(cursor.fetchall())
+
+
+def _pending_casts(current, wanted):
+    """Columnas existentes cuyo tipo cambió: {columna: (tipo nuevo, expresión de conversión)}."""
+    casts = {}
+    for name, sql_type in wanted:
+        if sql_type in _TYPE_MIGRATIONS and current.get(name) not in (None, _TYPE_MIGRATIONS[sql_type][0]):
+            casts[name] = (sql_type, _TYPE_MIGRATIONS[sql_type][1].format(col=name))
+    return casts
+
+
+def migrate_column_types(cursor, table, wanted):
+    """Convierte las columnas de una tabla existente a los tipos actuales (TIMESTAMPTZ, BIGINT).
+
+    Reescribe la tabla, así que solo corre una vez por instalación: después no hay cambios pendientes.
+    """
+    casts = _pending_casts(_current_types(cursor, table), wanted)
+    if not casts:
+        return
+    logger.warning(f"🛠️ Migrando tipos de {table}: {', '.join(f'{c} → {t}' for c, (t, _) in casts.items())}")
+    cursor.execute(f"ALTER TABLE {table} " + ", ".join(
+        f"ALTER COLUMN {name} TYPE {sql_type} USING {using}" for name, (sql_type, using) in casts.items()
+    ) + ";")
+    if "id" in casts:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id');", (table,))
+        sequence = cursor.fetchone()[0]
+        if sequence:
+            cursor.execute(f"ALTER SEQUENCE {sequence} AS BIGINT;")
+
+
+def partition_existing_table(cursor, entity):
+    """Convierte una tabla común de una versión anterior en la tabla particionada por mes.
+
+    Corre en la transacción del llamador: si algo falla, la tabla original queda intacta.
+    """
+    table, partition_by = entity.table, entity.partition_by
+    legacy = f"{table}_unpartitioned"
+    logger.warning(f"🛠️ Particionando {table} por mes de {partition_by} (copia completa de la tabla)")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy};")
+    cursor.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey;")
+    cursor.execute(entity_ddl(entity))
+
+    current = _current_types(cursor, legacy)
+    names = [name for name, _ in entity_columns(entity) if name in current]
+    casts = _pending_casts(current, entity_columns(entity))
+    select = [casts[name][1] if name in casts else name for name in names]
+    # Las filas sin fecha toman el default de la columna (la clave de partición no admite NULL)
+    default = next(c.default for c in entity.columns if c.name == partition_by)
+    key = select[names.index(partition_by)] = f"COALESCE({select[names.index(partition_by)]}, %s)"
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', {key} AT TIME ZONE 'UTC')::date FROM {legacy};", (default,))
+    for (month,) in cursor.fetchall():
+        cursor.execute(month_partition_ddl(entity, month))
+    cursor.execute(f"INSERT INTO {table} ({', '.join(names)}) SELECT {', '.join(select)} FROM {legacy};", (default,))
+    cursor.execute(f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(max(id), 0) + 1, false) FROM {table};",
+                   (table,))
+    cursor.execute(f"DROP TABLE {legacy};")
+
+
+def month_partition_ddl(entity, month):
+    """DDL de la partición de `month` (date del día 1) de una tabla particionada por mes (UTC)."""
+    following = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return (
+        f"CREATE TABLE IF NOT EXISTS {entity.table}_{month:%Y_%m} PARTITION OF {entity.table} "
+        f"FOR VALUES FROM ('{month} 00:00+00') TO ('{following} 00:00+00');"
+    )
+
+
+def ensure_month_partitions(entity, months, schema="hubspot"):
+    """Crea, en una transacción propia, las particiones mensuales que falten para `months`.
+
+    Si una partición no se puede crear (p. ej. la default ya tiene filas de ese mes), las
+    filas siguen yendo a la partición default.
+    """
+    with _partitions_lock:
+        missing = sorted(m for m in months if (schema, entity.table, m) not in _partitions)
+    if not missing:
+        return
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        for month in missing:
+            try:
+                cursor.execute(month_partition_ddl(entity, month))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.warning(f"⚠️ No se pudo crear la partición {month:%Y-%m} de {entity.table}: {e}")
+    with _partitions_lock:
+        _partitions.update((schema, entity.table, m) for m in missing)
+
+
+def index_name(entity, columns):
+    return f"{entity.table}_{'_'.join(columns)}_idx"
+
+
+def ensure_indexes(entity, schema="hubspot"):
+    """Crea los índices secundarios del registro que falten.
+
+    En tablas comunes usa CREATE INDEX CONCURRENTLY, que no bloquea las escrituras en
+    instalaciones con datos; un índice que quedó inválido por un intento cortado se borra y
+    se vuelve a crear. Las tablas particionadas no admiten CONCURRENTLY: el índice se crea
+    en la tabla madre y se propaga a cada partición.
+    """
+    concurrently = "" if entity.partition_by else " CONCURRENTLY"
+    with db_connection(schema) as conn:
+        conn.autocommit = True  # CONCURRENTLY no corre dentro de una transacción
+        try:
+            with conn.cursor() as cursor:
+                for columns in entity.indexes:
+                    name = index_name(entity, columns)
+                    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (name,))
+                    row = cursor.fetchone()
+                    if row and row[0]:
+                        continue
+                    if row:
+                        logger.warning(f"⚠️ Índice {name} inválido; se vuelve a crear")
+                        cursor.execute(f"DROP INDEX{concurrently} {name};")
+                    cursor.execute(f"CREATE INDEX{concurrently} IF NOT EXISTS {name} ON {entity.table} ({', '.join(columns)});")
+                    logger.info(f"🗂️ Índice {name} creado.")
+        finally:
+            conn.autocommit = False
+
+
+def init_entity_table(name, schema="hubspot"):
+    """Crea (o completa y migra) la tabla de una entidad del registro y sus índices."""
+    entity = get_entity(name)
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        kind, existing = _relkind(cursor, entity.table), None
+        if kind == "r" and entity.partition_by:
+            partition_existing_table(cursor, entity)
+        elif kind:
+            migrate_column_types(cursor, entity.table, entity_columns(entity))
+            existing = _current_types(cursor, entity.table)
+        cursor.execute(entity_ddl(entity, existing))
+        conn.commit()
+    ensure_indexes(entity, schema)
+    logger.info(f"✅ Tabla '{entity.table}' verificada o creada.")
 
 
 def init_contacts_table(schema="hubspot"):
     """Crea la tabla de contactos si no existe."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    query = """
-    CREATE TABLE IF NOT EXISTS contacts (
-        id SERIAL PRIMARY KEY,
-        hs_object_id VARCHAR(50) UNIQUE,
-        firstname VARCHAR(255),
-        lastname VARCHAR(255),
-        email VARCHAR(255),
-        phone VARCHAR(50),
-        createdate TIMESTAMP,
-        lastmodifieddate TIMESTAMP
-    );
-    """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ Tabla 'contacts' verificada o creada.")
+    init_entity_table("contacts", schema)
 
 
 def init_deals_table(schema="hubspot"):
     """Crea la tabla de deals si no existe."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    query = """
-    CREATE TABLE IF NOT EXISTS deals (
-        id SERIAL PRIMARY KEY,
-        hs_object_id VARCHAR(50) UNIQUE,
-        dealname VARCHAR(255),
-        dealstage VARCHAR(100),
-        pipeline VARCHAR(100),
-        amount NUMERIC(15,2),
-        closedate TIMESTAMP,
-        createdate TIMESTAMP,
-        lastmodifieddate TIMESTAMP
-    );
-    """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ Tabla 'deals' verificada o creada.")
+    init_entity_table("deals", schema)
 
 
 def init_leads_table(schema="hubspot"):
     """Crea la tabla de leads si no existe."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    query = """
-    CREATE TABLE IF NOT EXISTS leads (
-        id SERIAL PRIMARY KEY,
-        hs_object_id VARCHAR(50) UNIQUE,
-        firstname VARCHAR(255),
-        lastname VARCHAR(255),
-        email VARCHAR(255),
-        phone VARCHAR(50),
-        lifecyclestage VARCHAR(50),
-        createdate TIMESTAMP,
-        lastmodifieddate TIMESTAMP
-    );
-    """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ Tabla 'leads' verificada o creada.")
+    init_entity_table("leads", schema)
 
 
 def init_engagements_table(schema="hubspot"):
     """Crea la tabla de engagements (emails) si no existe."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    query = """
-    CREATE TABLE IF NOT EXISTS engagements (
-        id SERIAL PRIMARY KEY,
-        hs_object_id VARCHAR(50) UNIQUE,
-        hs_email_direction VARCHAR(20),
-        hs_timestamp TIMESTAMP,
-        hs_from_email VARCHAR(255),
-        hs_to_email VARCHAR(255),
-        hs_subject TEXT
-    );
-    """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ Tabla 'engagements' verificada o creada.")
-
-def init_sync_status_table(schema="hubspot"):
-    """Crea la tabla de control de sincronización incremental."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    query = """
-    CREATE TABLE IF NOT EXISTS sync_status (
-        entity VARCHAR(50) PRIMARY KEY,
-        last_sync TIMESTAMP
-    );
-    """
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ Tabla 'sync_status' verificada o creada.")
-
+    init_entity_table("engagements", schema)
@@ -0,0 +1,188 @@
+import os
+from collections import namedtuple
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+# Fecha para registros sin valor en la clave de partición (quedan en la partición de 1970-01)
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Registro de HubSpot reducido a lo que usa la sincronización (cache crudo, backend async)
+Record = namedtuple("Record", ["id", "properties"])
+
+
+@dataclass(frozen=True)
+class Column:
+    """Columna de una tabla sincronizada y la propiedad de HubSpot de la que sale."""
+    name: str
+    sql_type: str
+    kind: str = "str"           # str | int | datetime | float: conversión aplicada al extraer
+    update: bool = True         # se actualiza en el ON CONFLICT
+    hs_property: str = None     # por defecto, el mismo nombre de la columna
+    default: object = None      # valor si la propiedad viene vacía
+
+    @property
+    def prop(self):
+        return self.hs_property or self.name
+
+
+@dataclass(frozen=True)
+class Entity:
+    """Objeto de HubSpot sincronizado a una tabla del schema."""
+    name: str
+    object_type: str
+    label: str
+    icon: str
+    columns: tuple
+    modified_property: str = "hs_lastmodifieddate"
+    conflict_key: str = "hs_object_id"
+    match: dict = field(default=None)    # filtros EQ fijos, p. ej. {"lifecyclestage": "lead"}
+    derived_from: str = None             # entidad de cuyo stream salen sus registros
+    associations: tuple = ()             # tipos de objeto cuyas asociaciones van a la tabla associations
+    indexes: tuple = ()                  # índices secundarios: tuplas de columnas
+    partition_by: str = None             # columna de fecha para particionar la tabla por mes
+
+    @property
+    def table(self):
+        return self.name
+
+    @property
+    def properties(self):
+        return [c.prop for c in self.columns]
+
+    @property
+    def column_names(self):
+        return [c.name for c in self.columns]
+
+    @property
+    def conflict_columns(self):
+        """Clave única de la tabla: una tabla particionada debe incluir la clave de partición."""
+        return (self.conflict_key,) + ((self.partition_by,) if self.partition_by else ())
+
+    @property
+    def conflict_target(self):
+        return ", ".join(self.conflict_columns)
+
+    @property
+    def update_columns(self):
+        return [c.name for c in self.columns if c.update and c.name not in self.conflict_columns]
+
+    def matches(self, record):
+        """Indica si un registro de la entidad de origen pertenece a esta entidad."""
+        props = record.properties
+        return all(props.get(k) == v for k, v in (self.match or {}).items())
+
+
+_ID = Column("hs_object_id", "BIGINT", "int", update=False)
+
+CONTACTS = Entity(
+    name="contacts",
+    object_type="contacts",
+    label="contactos",
+    icon="📇",
+    modified_property="lastmodifieddate",
+    indexes=(("lastmodifieddate",), ("email",), ("lifecyclestage",)),
+    columns=(
+        _ID,
+        Column("firstname", "VARCHAR(255)"),
+        Column("lastname", "VARCHAR(255)"),
+        Column("email", "VARCHAR(255)"),
+        Column("phone", "VARCHAR(50)"),
+        Column("lifecyclestage", "VARCHAR(50)"),
+        Column("createdate", "TIMESTAMPTZ", "datetime", update=False),
+        Column("lastmodifieddate", "TIMESTAMPTZ", "datetime"),
+    ),
+)
+
+DEALS = Entity(
+    name="deals",
+    object_type="deals",
+    label="deals",
+    icon="💼",
+    associations=("contacts",),
+    indexes=(("lastmodifieddate",), ("pipeline", "dealstage"), ("closedate",)),
+    columns=(
+        _ID,
+        Column("dealname", "VARCHAR(255)"),
+        Column("dealstage", "VARCHAR(100)"),
+        Column("pipeline", "VARCHAR(100)"),
+        Column("amount", "NUMERIC(15,2)", "float"),
+        Column("closedate", "TIMESTAMPTZ", "datetime"),
+        Column("createdate", "TIMESTAMPTZ", "datetime", update=False),
+        Column("lastmodifieddate", "TIMESTAMPTZ", "datetime"),
+    ),
+)
+
+LEADS = Entity(
+    name="leads",
+    object_type="contacts",
+    label="leads",
+    icon="👥",
+    modified_property="lastmodifieddate",
+    indexes=(("lastmodifieddate",), ("email",)),
+    match={"lifecyclestage": "lead"},
+    derived_from="contacts",
+    columns=(
+        _ID,
+        Column("firstname", "VARCHAR(255)"),
+        Column("lastname", "VARCHAR(255)"),
+        Column("email", "VARCHAR(255)"),
+        Column("phone", "VARCHAR(50)"),
+        Column("lifecyclestage", "VARCHAR(50)"),
+        Column("createdate", "TIMESTAMPTZ", "datetime", update=False),
+        Column("lastmodifieddate", "TIMESTAMPTZ", "datetime"),
+    ),
+)
+
+ENGAGEMENTS = Entity(
+    name="engagements",
+    object_type="emails",
+    label="engagements",
+    icon="📩",
+    associations=("contacts",),
+    partition_by="hs_timestamp",
+    indexes=(("hs_timestamp",), ("hs_email_direction", "hs_timestamp"), ("hs_from_email",)),
+    columns=(
+        _ID,
+        Column("hs_email_direction", "VARCHAR(20)"),
+        Column("hs_timestamp", "TIMESTAMPTZ", "datetime", default=EPOCH),
+        Column("hs_from_email", "VARCHAR(255)"),
+        Column("hs_to_email", "VARCHAR(255)"),
+        Column("hs_subject", "TEXT"),
+    ),
+)
+
+ENTITIES = {e.name: e for e in (CONTACTS, DEALS, LEADS, ENGAGEMENTS)}
+
+
+def get_entity(name):
+    """Devuelve la definición de una entidad registrada."""
+    try:
+        return ENTITIES[name]
+    except KeyError:
+        raise ValueError(f"Entidad desconocida: {name}") from None
+
+
+def root_entities():
+    """Entidades que se descargan de HubSpot (no derivadas de otro stream)."""
+    return [e for e in ENTITIES.values() if e.derived_from is None]
+
+
+def derived_entities(name):
+    """Entidades que se derivan del stream de `name`."""
+    return [e for e in ENTITIES.values() if e.derived_from == name]
+
+
+def extra_property_setting(entity):
+    """Propiedades extra de una entidad, que van a su columna JSONB `extra`.
+
+    Se configuran en HUBSPOT_PROPERTIES_<ENTIDAD> (o HUBSPOT_PROPERTIES para todas): vacío
+    (solo columnas, devuelve None), "all" (todas las del properties API) o una lista separada
+    por comas (devuelve la tupla de las que no son columnas).
+    """
+    setting = os.getenv(f"HUBSPOT_PROPERTIES_{entity.name.upper()}", os.getenv("HUBSPOT_PROPERTIES", "")).strip()
+    if not setting:
+        return None
+    if setting.lower() == "all":
+        return "all"
+    known = set(entity.properties)
+    return tuple(sorted({p.strip() for p in setting.split(",") if p.strip()} - known)) or None
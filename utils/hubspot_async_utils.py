@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import random
+from collections import deque
+from utils import metrics
+from utils.entities import Record, get_entity
+from utils.hubspot_utils import (
+    BATCH_READ_SIZE, HUBSPOT_MAX_RETRIES, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS, SEARCH_PAGE_SIZE,
+    SEARCH_RESULT_CAP, entity_filters, fetch_properties, get_portal, id_range_filters
+)
+from utils.logger import logger
+
+HUBSPOT_API_URL = os.getenv("HUBSPOT_API_URL", "https://api.hubapi.com")
+# Requests en vuelo por entidad (y conexiones keep-alive de su sesión)
+HUBSPOT_ASYNC_CONCURRENCY = int(os.getenv("HUBSPOT_ASYNC_CONCURRENCY", "100"))
+# Segmentos de hs_object_id descargados a la vez por entidad y registros aproximados por segmento
+HUBSPOT_ASYNC_SEGMENTS = int(os.getenv("HUBSPOT_ASYNC_SEGMENTS", "16"))
+HUBSPOT_ASYNC_SEGMENT_RECORDS = int(os.getenv("HUBSPOT_ASYNC_SEGMENT_RECORDS", "2000"))
+
+
+class HubSpotHTTPError(Exception):
+    """Respuesta de error de la API REST de HubSpot (backend async)."""
+
+    def __init__(self, status, body, headers=None):
+        super().__init__(f"HTTP {status}: {body[:500]!r}")
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+async def acquire(bucket):
+    """Versión async de TokenBucket.acquire: espera sin bloquear el event loop."""
+    waited = 0.0
+    while wait := bucket.try_acquire():
+        await asyncio.sleep(wait)
+        waited += wait
+    return waited
+
+
+async def call_hubspot_async(session, semaphore, path, body, portal=None, search=False, entity=None,
+                             stage="api_call"):
+    """POST a la API REST con el mismo rate limit, cuota, reintentos y métricas que call_hubspot."""
+    portal = get_portal(portal)
+    bucket = portal.search_bucket if search else portal.api_bucket
+    for attempt in range(HUBSPOT_MAX_RETRIES + 1):
+        waited = await acquire(bucket)
+        if waited:
+            metrics.observe(entity, "rate_limit_wait", waited)
+        portal.quota.consume()
+        async with semaphore:
+            with metrics.timed(entity, stage):
+                async with session.post(f"{HUBSPOT_API_URL}{path}", json=body) as response:
+                    data = await response.read()
+                    status, headers = response.status, response.headers
+        portal.quota.observe(headers)
+        if status < 400:
+            metrics.incr(entity, "bytes_received", len(data))
+            return json.loads(data)
+
+        metrics.incr(entity, f"http_{status}_errors")
+        error = HubSpotHTTPError(status, data, headers)
+        if attempt == HUBSPOT_MAX_RETRIES or not (status == 429 or status >= 500):
+            raise error
+        metrics.incr(entity, "retries")
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if status == 429:
+            try:
+                delay = float(headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                pass
+            bucket.pause(delay)
+        logger.warning(f"🔁 HubSpot respondió {status}; reintento {attempt + 1}/{HUBSPOT_MAX_RETRIES} en {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+async def search_ids(session, semaphore, entity, filters, page_size=SEARCH_PAGE_SIZE, portal=None):
+    """Versión async de iter_search_pages: genera listas de IDs ordenadas por hs_object_id."""
+    after = None
+    last_id = None
+    while True:
+        page_filters = list(filters)
+        if last_id is not None:
+            page_filters.append({"propertyName": "hs_object_id", "operator": "GT", "value": last_id})
+        body = {
+            "limit": page_size,
+            "properties": ["hs_object_id"],
+            "sorts": [{"propertyName": "hs_object_id", "direction": "ASCENDING"}],
+        }
+        if after:
+            body["after"] = after
+        if page_filters:
+            body["filterGroups"] = [{"filters": page_filters}]
+        search = await call_hubspot_async(session, semaphore, f"/crm/v3/objects/{entity.object_type}/search", body,
+                                          portal=portal, search=True, entity=entity.name, stage="search")
+        results = search.get("results") or []
+        if not results:
+            return
+        yield [r["id"] for r in results]
+
+        after_next = ((search.get("paging") or {}).get("next") or {}).get("after")
+        if not after_next:
+            return
+        if int(after_next) + page_size > SEARCH_RESULT_CAP:
+            last_id = results[-1]["id"]
+            after = None
+        else:
+            after = after_next
+
+
+async def read_batch(session, semaphore, entity, ids, properties, portal=None):
+    """Batch read de hasta BATCH_READ_SIZE IDs; devuelve Records (id y properties)."""
+    body = {"inputs": [{"id": oid} for oid in ids], "properties": properties}
+    response = await call_hubspot_async(session, semaphore, f"/crm/v3/objects/{entity.object_type}/batch/read",
+                                        body, portal=portal, entity=entity.name, stage="batch_read")
+    return [Record(r["id"], r["properties"]) for r in response.get("results") or []]
+
+
+async def id_bounds(session, semaphore, entity, filters, portal=None):
+    """Total y hs_object_id mínimo y máximo de una búsqueda (dos búsquedas de 1 resultado)."""
+    async def first(direction):
+        body = {
+            "limit": 1,
+            "properties": ["hs_object_id"],
+            "sorts": [{"propertyName": "hs_object_id", "direction": direction}],
+        }
+        if filters:
+            body["filterGroups"] = [{"filters": filters}]
+        return await call_hubspot_async(session, semaphore, f"/crm/v3/objects/{entity.object_type}/search", body,
+                                        portal=portal, search=True, entity=entity.name, stage="search")
+
+    lowest, highest = await asyncio.gather(first("ASCENDING"), first("DESCENDING"))
+    if not lowest.get("results"):
+        return 0, None, None
+    return lowest.get("total", 0), int(lowest["results"][0]["id"]), int(highest["results"][0]["id"])
+
+
+async def segment_pages(session, semaphore, entity, filters, properties, page_size=SEARCH_PAGE_SIZE, portal=None):
+    """Páginas de un segmento de IDs: su búsqueda es secuencial, sus batch reads van en paralelo."""
+    reads = []
+    async for ids in search_ids(session, semaphore, entity, filters, page_size, portal):
+        for i in range(0, len(ids), BATCH_READ_SIZE):
+            chunk = ids[i:i + BATCH_READ_SIZE]
+            reads.append(asyncio.ensure_future(read_batch(session, semaphore, entity, chunk, properties, portal)))
+    try:
+        return await asyncio.gather(*reads)
+    finally:
+        for task in reads:
+            task.cancel()
+
+
+async def entity_pages(session, semaphore, entity, filters, properties, page_size=SEARCH_PAGE_SIZE,
+                       segments=HUBSPOT_ASYNC_SEGMENTS, portal=None):
+    """Parte la búsqueda en segmentos de hs_object_id de ~HUBSPOT_ASYNC_SEGMENT_RECORDS registros y
+    descarga hasta `segments` a la vez; entrega las páginas en orden de ID (los checkpoints lo requieren).
+
+    La Search API pagina con un cursor secuencial, así que una sola búsqueda no admite
+    paralelismo: los segmentos son lo que permite tener muchas llamadas en vuelo.
+    """
+    total, low, high = await id_bounds(session, semaphore, entity, filters, portal)
+    if not total:
+        return
+    count = max(1, min(total // HUBSPOT_ASYNC_SEGMENT_RECORDS, high - low + 1))
+    # El último segmento queda abierto para incluir IDs creados durante la descarga
+    edges = [low + (high - low + 1) * i // count for i in range(count)] + [None]
+    ranges = [filters + id_range_filters((edges[i], edges[i + 1])) for i in range(count)]
+    pending = deque()
+    try:
+        for segment_filters in ranges:
+            segment = segment_pages(session, semaphore, entity, segment_filters, properties, page_size, portal)
+            pending.append(asyncio.ensure_future(segment))
+            while len(pending) >= segments:
+                for page in await pending.popleft():
+                    yield page
+        while pending:
+            for page in await pending.popleft():
+                yield page
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def get_entity_batch_async(name, page_size=SEARCH_PAGE_SIZE, since=None, id_range=None, after_id=None,
+                           portal=None):
+    """Igual que hubspot_utils.get_entity_batch, pero con aiohttp: una sesión keep-alive por
+    descarga y hasta HUBSPOT_ASYNC_CONCURRENCY requests en vuelo desde un solo hilo.
+
+    Es un generador síncrono: cada página se obtiene corriendo el event loop propio hasta
+    la siguiente, así que encaja sin cambios en sync_entity.
+    """
+    import aiohttp      # dependencia opcional: solo para HUBSPOT_BACKEND=async
+
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    filters = entity_filters(entity, since, id_range)
+    if after_id is not None:
+        filters.append({"propertyName": "hs_object_id", "operator": "GT", "value": str(after_id)})
+
+    loop = asyncio.new_event_loop()
+
+    async def open_session():
+        connector = aiohttp.TCPConnector(limit=HUBSPOT_ASYNC_CONCURRENCY, keepalive_timeout=60)
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={"Authorization": f"Bearer {portal.token}"},
+            timeout=aiohttp.ClientTimeout(total=120),
+        )
+
+    session = loop.run_until_complete(open_session())
+    semaphore = asyncio.Semaphore(HUBSPOT_ASYNC_CONCURRENCY)
+    pages = entity_pages(session, semaphore, entity, filters, fetch_properties(entity, portal), page_size,
+                         portal=portal)
+    total = 0
+    try:
+        logger.info(f"📡 Obteniendo {entity.label} (backend async, {HUBSPOT_ASYNC_CONCURRENCY} en vuelo)...")
+        while True:
+            try:
+                page = loop.run_until_complete(pages.__anext__())
+            except StopAsyncIteration:
+                break
+            if not page:
+                continue
+            total += len(page)
+            metrics.incr(name, "records_received", len(page))
+            yield page
+    finally:
+        loop.run_until_complete(pages.aclose())
+        loop.run_until_complete(session.close())
+        loop.close()
+
+    if total:
+        logger.info(f"⚡ {total} {entity.label} obtenidos.")
+    else:
+        logger.info(f"⚠️ No se encontraron {entity.label}.")
@@ -1,148 +1,755 @@
+import json
 import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from operator import attrgetter
 from dotenv import load_dotenv
-from hubspot import HubSpot
-from hubspot.crm.contacts import (
-    ApiException as ContactsApiException,
-    PublicObjectSearchRequest,
-    BatchReadInputSimplePublicObjectId
-)
-from hubspot.crm.deals import (
-    ApiException as DealsApiException,
-    PublicObjectSearchRequest as DealSearchRequest,
-    BatchReadInputSimplePublicObjectId as DealBatchInput
-)
-from hubspot.crm.objects import (
-    ApiException as ObjectsApiException,
-    PublicObjectSearchRequest as ObjectSearchRequest,
-    BatchReadInputSimplePublicObjectId as ObjectBatchInput
-)
+from utils import metrics
+from utils.entities import derived_entities, extra_property_setting, get_entity
 from utils.logger import logger
 
 load_dotenv()
 ACCESS_TOKEN = os.getenv("HUBSPOT_TOKEN")
 
+SEARCH_PAGE_SIZE = 100      # máximo de resultados por página de la Search API
+SEARCH_RESULT_CAP = 10000   # la Search API no pagina más allá de 10.000 resultados por consulta
+BATCH_READ_SIZE = 100       # máximo de IDs por llamada a batch read
+ASSOCIATIONS_BATCH_SIZE = 1000  # máximo de IDs por llamada al batch read de asociaciones v4
+
+# Concurrencia y límites de HubSpot (apps privadas: 100 req/10 s, Search API: 5 req/s)
+HUBSPOT_MAX_WORKERS = int(os.getenv("HUBSPOT_MAX_WORKERS", "8"))
+HUBSPOT_RATE_PER_SECOND = float(os.getenv("HUBSPOT_RATE_PER_SECOND", "9"))
+HUBSPOT_SEARCH_RATE_PER_SECOND = float(os.getenv("HUBSPOT_SEARCH_RATE_PER_SECOND", "4"))
+# Tope de llamadas por día del portal; se compara también con el uso que informa HubSpot en cada respuesta
+HUBSPOT_DAILY_LIMIT = int(os.getenv("HUBSPOT_DAILY_LIMIT", "250000"))
+HUBSPOT_MAX_RETRIES = int(os.getenv("HUBSPOT_MAX_RETRIES", "5"))
+# Cache de los nombres de propiedades por tipo de objeto (HUBSPOT_PROPERTIES=all)
+HUBSPOT_PROPERTIES_CACHE = os.getenv("HUBSPOT_PROPERTIES_CACHE", "data/properties_cache.json")
+HUBSPOT_PROPERTIES_TTL_HOURS = float(os.getenv("HUBSPOT_PROPERTIES_TTL_HOURS", "24"))
+# Backend de descarga de entidades: "sdk" (hubspot-api-client en hilos) o "async" (aiohttp)
+HUBSPOT_BACKEND = os.getenv("HUBSPOT_BACKEND", "sdk").lower()
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+
+# El SDK se importa en el primer uso (cuesta ~100 ms de arranque que --replay, --serve o el
+# backend async no necesitan); sus ApiException se reconocen por los módulos ya cargados
+SDK_EXCEPTION_MODULES = (
+    "hubspot.crm.objects.exceptions",
+    "hubspot.crm.associations.v4.exceptions",
+    "hubspot.crm.properties.exceptions",
+)
 
-def get_hubspot_client():
-    return HubSpot(access_token=ACCESS_TOKEN)
-
-
-# -------------------- CONTACTS --------------------
-def get_contacts_batch(limit=10000):
-    client = get_hubspot_client()
-    PROPS = ["firstname", "lastname", "email", "phone", "createdate", "lastmodifieddate", "hs_object_id"]
 
+def is_api_exception(error):
+    """Indica si `error` es una ApiException de alguna API del SDK usada en este proceso."""
+    for name in SDK_EXCEPTION_MODULES:
+        module = sys.modules.get(name)
+        if module is not None and isinstance(error, module.ApiException):
+            return True
+    return False
+
+
+def object_models():
+    """Modelos de crm.objects para búsquedas y batch reads: (SearchRequest, BatchReadInput)."""
+    from hubspot.crm.objects import BatchReadInputSimplePublicObjectId, PublicObjectSearchRequest
+    return PublicObjectSearchRequest, BatchReadInputSimplePublicObjectId
+
+
+class DailyQuotaExceeded(Exception):
+    """Se agotó el presupuesto diario de llamadas a la API de HubSpot."""
+
+
+class TokenBucket:
+    """Token bucket thread-safe: `rate` llamadas por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Consume un token si hay uno disponible (devuelve 0) o devuelve los segundos a esperar."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now >= self._paused_until and self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+    def acquire(self):
+        """Bloquea hasta que haya un token disponible, lo consume y devuelve los segundos esperados."""
+        waited = 0.0
+        while wait := self.try_acquire():
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    def set_rate(self, rate, capacity=None):
+        """Cambia la tasa (p. ej. al repartir el presupuesto entre procesos)."""
+        with self._lock:
+            self.rate = rate
+            self.capacity = capacity or max(1.0, rate)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds):
+        """Detiene a todos los consumidores (p. ej. tras un 429 con Retry-After)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class DailyQuota:
+    """Cuota diaria (UTC) de un portal: corta cuando este proceso llega a `limit` llamadas o
+    cuando el uso del día del portal que informa HubSpot (X-HubSpot-RateLimit-Daily y
+    -Daily-Remaining, que cuentan otras corridas e integraciones) llega a `portal_limit`.
+
+    Entre respuestas con esos headers el uso del portal se estima sumando las llamadas propias.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.portal_limit = limit
+        self._day = None
+        self._used = 0
+        self._portal_used = 0
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            self._day, self._used, self._portal_used = today, 0, 0
+
+    def consume(self):
+        with self._lock:
+            self._roll()
+            if self.portal_limit and self._portal_used >= self.portal_limit:
+                raise DailyQuotaExceeded(
+                    f"HubSpot informa {self._portal_used} llamadas del portal hoy (límite {self.portal_limit})"
+                )
+            if self.limit and self._used >= self.limit:
+                raise DailyQuotaExceeded(f"Límite diario de {self.limit} llamadas alcanzado")
+            self._used += 1
+            self._portal_used += 1
+
+    def observe(self, headers):
+        """Toma el uso del día del portal de los headers de una respuesta de HubSpot (si vienen)."""
+        try:
+            daily = int(headers.get("X-HubSpot-RateLimit-Daily"))
+            remaining = int(headers.get("X-HubSpot-RateLimit-Daily-Remaining"))
+        except (AttributeError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._roll()
+            self._portal_used = max(0, daily - remaining)
+
+
+# -------------------- PORTALES --------------------
+# Portales a sincronizar, separados por coma; cada uno lee HUBSPOT_TOKEN_<PORTAL> y, opcionales,
+# HUBSPOT_SCHEMA_<PORTAL> (por defecto hubspot_<portal>), HUBSPOT_RATE_PER_SECOND_<PORTAL>,
+# HUBSPOT_SEARCH_RATE_PER_SECOND_<PORTAL> y HUBSPOT_DAILY_LIMIT_<PORTAL>.
+# Sin HUBSPOT_PORTALS se sincroniza un solo portal: HUBSPOT_TOKEN en el schema "hubspot".
+HUBSPOT_PORTALS = [p.strip() for p in os.getenv("HUBSPOT_PORTALS", "").split(",") if p.strip()]
+
+
+@dataclass(eq=False)
+class Portal:
+    """Cuenta de HubSpot a sincronizar: su token, su schema y su propio presupuesto de API.
+
+    Los límites de HubSpot son por cuenta, así que cada portal tiene sus token buckets, su
+    cuota diaria, su cliente y su pool de hilos de batch reads: uno que espera su rate limit
+    no ocupa los hilos de los demás.
+    """
+    name: str
+    token: str
+    schema: str = "hubspot"
+    rate: float = HUBSPOT_RATE_PER_SECOND
+    search_rate: float = HUBSPOT_SEARCH_RATE_PER_SECOND
+    daily_limit: int = HUBSPOT_DAILY_LIMIT
+    api_bucket: TokenBucket = field(init=False, repr=False)
+    search_bucket: TokenBucket = field(init=False, repr=False)
+    quota: DailyQuota = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.api_bucket = TokenBucket(self.rate)
+        self.search_bucket = TokenBucket(self.search_rate)
+        self.quota = DailyQuota(self.daily_limit)
+
+    def share_rate_limits(self, workers):
+        """Deja a este proceso con 1/workers del rate limit y de la cuota diaria del portal."""
+        self.api_bucket.set_rate(self.rate / workers)
+        self.search_bucket.set_rate(self.search_rate / workers)
+        self.quota.limit = self.daily_limit // workers   # el uso del portal que informa HubSpot ya es global
+
+
+DEFAULT_PORTAL = Portal("default", ACCESS_TOKEN)
+API_BUCKET = DEFAULT_PORTAL.api_bucket
+SEARCH_BUCKET = DEFAULT_PORTAL.search_bucket
+DAILY_QUOTA = DEFAULT_PORTAL.quota
+
+_portals = {}
+_portals_lock = threading.Lock()
+
+
+def _portal_from_env(name):
+    suffix = name.upper()
+    token = os.getenv(f"HUBSPOT_TOKEN_{suffix}")
+    if not token:
+        raise ValueError(f"Falta HUBSPOT_TOKEN_{suffix} para el portal {name}")
+    schema = os.getenv(f"HUBSPOT_SCHEMA_{suffix}", f"hubspot_{name}".lower())
+    if not schema.replace("_", "").isalnum():
+        raise ValueError(f"Schema inválido para el portal {name}: {schema!r}")
+    return Portal(
+        name, token, schema,
+        rate=float(os.getenv(f"HUBSPOT_RATE_PER_SECOND_{suffix}", HUBSPOT_RATE_PER_SECOND)),
+        search_rate=float(os.getenv(f"HUBSPOT_SEARCH_RATE_PER_SECOND_{suffix}", HUBSPOT_SEARCH_RATE_PER_SECOND)),
+        daily_limit=int(os.getenv(f"HUBSPOT_DAILY_LIMIT_{suffix}", HUBSPOT_DAILY_LIMIT)),
+    )
+
+
+def get_portals():
+    """Portales configurados (HUBSPOT_PORTALS), creados una vez por proceso; [DEFAULT_PORTAL] si no hay."""
+    with _portals_lock:
+        if not _portals:
+            portals = [_portal_from_env(name) for name in HUBSPOT_PORTALS] or [DEFAULT_PORTAL]
+            schemas = [p.schema for p in portals]
+            if len(set(schemas)) < len(schemas):
+                raise ValueError(f"Dos portales no pueden compartir schema: {schemas}")
+            _portals.update((p.name, p) for p in portals)
+        return list(_portals.values())
+
+
+def get_portal(portal=None):
+    """Portal por nombre (o el mismo Portal); None es el único portal configurado o DEFAULT_PORTAL."""
+    if isinstance(portal, Portal):
+        return portal
+    portals = get_portals()
+    if portal is None:
+        return portals[0] if len(portals) == 1 else DEFAULT_PORTAL
+    for candidate in portals:
+        if candidate.name == portal:
+            return candidate
+    raise ValueError(f"Portal desconocido: {portal} (configurados: {', '.join(p.name for p in portals)})")
+
+
+def share_rate_limits(workers):
+    """Deja a este proceso con 1/workers del rate limit y de la cuota diaria de cada portal (modo --workers)."""
+    for portal in get_portals():
+        portal.share_rate_limits(workers)
+
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def get_executor(portal=None):
+    """Pool de hilos de un portal para las lecturas batch de todas sus entidades."""
+    portal = get_portal(portal)
+    with _executor_lock:
+        if portal.name not in _executors:
+            _executors[portal.name] = ThreadPoolExecutor(max_workers=HUBSPOT_MAX_WORKERS,
+                                                         thread_name_prefix=f"hubspot-{portal.name}")
+        return _executors[portal.name]
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
     try:
-        logger.info("📡 Obteniendo lista de IDs de contactos...")
-        search_request = PublicObjectSearchRequest(limit=limit, properties=["hs_object_id"])
-        search = client.crm.contacts.search_api.do_search(public_object_search_request=search_request)
-        contact_ids = [r.id for r in search.results]
-
-        if not contact_ids:
-            logger.info("⚠️ No se encontraron contactos.")
-            return []
-
-        batch_input = BatchReadInputSimplePublicObjectId(inputs=[{"id": cid} for cid in contact_ids])
-        response = client.crm.contacts.batch_api.read(batch_read_input_simple_public_object_id=batch_input, properties=PROPS)
-
-        results = response.results
-        logger.info(f"⚡ {len(results)} contactos obtenidos.")
-        if results:
-            logger.debug(f"📋 Ejemplo: {results[0].properties}")
-        return results
-
-    except ContactsApiException as e:
-        logger.error(f"❌ Error al obtener contactos (Batch Read): {e}")
-        return []
-
-
-# -------------------- DEALS --------------------
-def get_deals_batch(limit=10000):
-    client = get_hubspot_client()
-    PROPS = ["dealname", "dealstage", "pipeline", "amount", "closedate", "createdate", "lastmodifieddate", "hs_object_id"]
-
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def call_hubspot(fn, *args, portal=None, search=False, entity=None, stage="api_call", **kwargs):
+    """Ejecuta una llamada a HubSpot respetando el rate limit del portal, con reintentos en 429 y 5xx.
+
+    `search=True` usa el bucket de la Search API. Registra en metrics la duración de la
+    llamada (etapa `stage`), la espera por rate limit, los reintentos y los códigos de error
+    de la entidad.
+    """
+    portal = get_portal(portal)
+    bucket = portal.search_bucket if search else portal.api_bucket
+    for attempt in range(HUBSPOT_MAX_RETRIES + 1):
+        waited = bucket.acquire()
+        if waited:
+            metrics.observe(entity, "rate_limit_wait", waited)
+        portal.quota.consume()
+        try:
+            with metrics.timed(entity, stage):
+                response = fn(*args, **kwargs)
+            portal.quota.observe(_last_response_headers())
+            return response
+        except Exception as e:
+            if not is_api_exception(e):
+                raise
+            portal.quota.observe(getattr(e, "headers", None))
+            status = getattr(e, "status", None) or 0
+            metrics.incr(entity, f"http_{status}_errors")
+            if attempt == HUBSPOT_MAX_RETRIES or not (status == 429 or status >= 500):
+                raise
+            metrics.incr(entity, "retries")
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if status == 429:
+                delay = _retry_after(e) or delay
+                bucket.pause(delay)
+            logger.warning(f"🔁 HubSpot respondió {status}; reintento {attempt + 1}/{HUBSPOT_MAX_RETRIES} en {delay:.1f}s")
+            time.sleep(delay)
+
+
+_clients = {}
+_client_lock = threading.Lock()
+
+
+def get_hubspot_client(portal=None):
+    """Cliente de HubSpot de un portal, creado una sola vez por proceso (sus APIs se reutilizan
+    por hilo en cached_api)."""
+    portal = get_portal(portal)
+    with _client_lock:
+        if portal.name not in _clients:
+            from hubspot import HubSpot
+            _clients[portal.name] = HubSpot(access_token=portal.token)
+        return _clients[portal.name]
+
+
+_thread_apis = threading.local()
+
+
+def cached_api(client, path):
+    """API del SDK (p. ej. "crm.objects.search_api") reutilizada por hilo.
+
+    El SDK arma un ApiClient nuevo en cada acceso a `client.crm.objects.<api>`; reutilizarlo
+    por hilo evita eso y deja `last_response` libre de carreras para medir bytes recibidos.
+    """
+    apis = _thread_apis.__dict__.setdefault("apis", {})
+    cached = apis.get(path)
+    if cached is None or cached[0] is not client:
+        cached = apis[path] = (client, attrgetter(path)(client))
+    _thread_apis.last = cached[1]
+    return cached[1]
+
+
+def _last_response_headers():
+    """Headers de la última respuesta que recibió en este hilo una API de cached_api (o None)."""
+    last_response = getattr(getattr(getattr(_thread_apis, "last", None), "api_client", None), "last_response", None)
+    getheaders = getattr(last_response, "getheaders", None)
+    return getheaders() if getheaders else None
+
+
+def response_bytes(api):
+    """Tamaño del último cuerpo de respuesta recibido por una API del SDK (0 si no se conoce)."""
+    last_response = getattr(getattr(api, "api_client", None), "last_response", None)
+    return len(getattr(last_response, "data", None) or b"")
+
+
+_properties = {}
+_properties_lock = threading.Lock()
+
+
+def _write_properties_cache(path, stored):
+    """Escribe el cache de propiedades a través de un temporal propio (varios procesos de --workers
+    pueden escribirlo a la vez). Si falla solo se avisa: los nombres ya están en memoria."""
+    directory = os.path.dirname(path) or "."
+    tmp = None
     try:
-        logger.info("📡 Obteniendo lista de IDs de deals...")
-        search_request = DealSearchRequest(limit=limit, properties=["hs_object_id"])
-        search = client.crm.deals.search_api.do_search(public_object_search_request=search_request)
-        deal_ids = [r.id for r in search.results]
-
-        if not deal_ids:
-            logger.info("⚠️ No se encontraron deals.")
-            return []
-
-        batch_input = DealBatchInput(inputs=[{"id": did} for did in deal_ids])
-        response = client.crm.deals.batch_api.read(batch_read_input_simple_public_object_id=batch_input, properties=PROPS)
-
-        results = response.results
-        logger.info(f"⚡ {len(results)} deals obtenidos.")
-        if results:
-            logger.debug(f"📋 Ejemplo: {results[0].properties}")
-        return results
-
-    except DealsApiException as e:
-        logger.error(f"❌ Error al obtener deals (Batch Read): {e}")
-        return []
-
-
-# -------------------- LEADS --------------------
-def get_leads_batch(limit=10000):
-    client = get_hubspot_client()
-    PROPS = ["firstname", "lastname", "email", "phone", "lifecyclestage", "createdate", "lastmodifieddate", "hs_object_id"]
-
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(stored, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"⚠️ No se pudo guardar el cache de propiedades en {path}: {e}")
+        if tmp and os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def _read_properties_cache(path):
     try:
-        logger.info("📡 Obteniendo lista de IDs de contactos para leads...")
-        search_request = PublicObjectSearchRequest(limit=limit, properties=["hs_object_id", "lifecyclestage"])
-        search = client.crm.contacts.search_api.do_search(public_object_search_request=search_request)
-
-        lead_ids = [r.id for r in search.results if r.properties.get("lifecyclestage") == "lead"]
-
-        if not lead_ids:
-            logger.info("⚠️ No se encontraron leads.")
-            return []
-
-        batch_input = BatchReadInputSimplePublicObjectId(inputs=[{"id": lid} for lid in lead_ids])
-        response = client.crm.contacts.batch_api.read(batch_read_input_simple_public_object_id=batch_input, properties=PROPS)
-
-        results = response.results
-        logger.info(f"⚡ {len(results)} leads obtenidos.")
-        if results:
-            logger.debug(f"📋 Ejemplo: {results[0].properties}")
-        return results
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def discover_properties(object_type, path=HUBSPOT_PROPERTIES_CACHE, ttl_hours=HUBSPOT_PROPERTIES_TTL_HOURS,
+                        portal=None):
+    """Nombres de todas las propiedades de un tipo de objeto (properties API), cacheados en
+    memoria y en `path` por ttl_hours; si la API falla se usa el cache vencido, si lo hay.
+
+    Cada portal tiene sus propiedades personalizadas: fuera del portal por defecto la clave
+    del cache es "<portal>:<tipo>".
+    """
+    portal = get_portal(portal)
+    key = object_type if portal is DEFAULT_PORTAL else f"{portal.name}:{object_type}"
+    with _properties_lock:
+        cached = _properties.get(key) or _read_properties_cache(path).get(key)
+        if cached and time.time() - cached["fetched_at"] < ttl_hours * 3600:
+            _properties[key] = cached
+            return cached["names"]
+        try:
+            api = cached_api(get_hubspot_client(portal), "crm.properties.core_api")
+            response = call_hubspot(api.get_all, portal=portal, entity=object_type, stage="properties",
+                                    object_type=object_type, archived=False)
+        except Exception as e:
+            if not cached or not is_api_exception(e):
+                raise
+            logger.warning(f"⚠️ No se pudieron leer las propiedades de {key} ({e}); se usa el cache vencido")
+            return cached["names"]
+        cached = _properties[key] = {"fetched_at": time.time(), "names": sorted(p.name for p in response.results)}
+        stored = _read_properties_cache(path)
+        stored[key] = cached
+        _write_properties_cache(path, stored)
+        logger.info(f"🏷️ {len(cached['names'])} propiedades de {key} descubiertas")
+        return cached["names"]
+
+
+def fetch_properties(entity, portal=None):
+    """Propiedades a pedir para una entidad: sus columnas más las extra configuradas en ella y
+    en sus derivadas (que salen del mismo stream)."""
+    names = list(entity.properties)
+    for target in [entity] + derived_entities(entity.name):
+        setting = extra_property_setting(target)
+        if setting == "all":
+            extras = discover_properties(entity.object_type, portal=portal)
+        else:
+            extras = setting or ()
+        names.extend(p for p in extras if p not in names)
+    return names
+
+
+# -------------------- MOTOR DE EXTRACCIÓN --------------------
+def iter_search_pages(do_search, request_cls, properties=None, filters=None, page_size=SEARCH_PAGE_SIZE, entity=None,
+                      portal=None):
+    """Recorre la Search API siguiendo paging.next.after y genera páginas de resultados.
+
+    Ordena por hs_object_id; al acercarse al tope de 10.000 resultados reinicia la
+    búsqueda con un filtro hs_object_id > último ID visto.
+    """
+    after = None
+    last_id = None
+    while True:
+        page_filters = list(filters or [])
+        if last_id is not None:
+            page_filters.append({"propertyName": "hs_object_id", "operator": "GT", "value": last_id})
+
+        search_request = request_cls(
+            limit=page_size,
+            after=after,
+            properties=properties or ["hs_object_id"],
+            sorts=[{"propertyName": "hs_object_id", "direction": "ASCENDING"}],
+            filter_groups=[{"filters": page_filters}] if page_filters else None,
+        )
+        search = call_hubspot(do_search, portal=portal, search=True, entity=entity, stage="search",
+                              public_object_search_request=search_request)
+        if not search.results:
+            return
+        yield search.results
+
+        paging_next = search.paging.next if search.paging else None
+        if not paging_next or not paging_next.after:
+            return
+        if int(paging_next.after) + page_size > SEARCH_RESULT_CAP:
+            last_id = search.results[-1].id
+            after = None
+        else:
+            after = paging_next.after
+
+
+def batch_read(read, input_cls, ids, properties, entity=None, portal=None):
+    """Lee un bloque de hasta BATCH_READ_SIZE IDs."""
+    batch_input = input_cls(inputs=[{"id": oid} for oid in ids], properties=properties)
+    response = call_hubspot(read, portal=portal, entity=entity, stage="batch_read",
+                            batch_read_input_simple_public_object_id=batch_input)
+    return response.results
+
+
+def modified_since_filters(prop, since):
+    """Filtro GTE sobre la propiedad de última modificación (HubSpot espera epoch en ms)."""
+    if since is None:
+        return None
+    return [{"propertyName": prop, "operator": "GTE", "value": str(int(since.timestamp() * 1000))}]
+
+
+def extract_pages(label, do_search, read, request_cls, input_cls, props,
+                  search_properties=None, filters=None, page_size=SEARCH_PAGE_SIZE, entity=None, portal=None):
+    """Generador de páginas de registros: búsqueda paginada de IDs + batch read por bloques.
+
+    Los batch reads se reparten en el pool del portal (como mucho 2 × HUBSPOT_MAX_WORKERS
+    en vuelo por entidad) y las páginas se entregan en el orden de la búsqueda.
+    """
+    executor = get_executor(portal)
+    pending = deque()
+    max_in_flight = 2 * HUBSPOT_MAX_WORKERS
+    total = 0
+
+    def drain(keep):
+        nonlocal total
+        while len(pending) > keep:
+            page = pending.popleft().result()
+            if not page:
+                continue
+            if total == 0:
+                logger.debug(f"📋 Ejemplo: {page[0].properties}")
+            total += len(page)
+            metrics.incr(entity, "records_received", len(page))
+            yield page
 
-    except ContactsApiException as e:
-        logger.error(f"❌ Error al obtener leads (Batch Read): {e}")
+    try:
+        for results in iter_search_pages(do_search, request_cls, search_properties, filters,
+                                         page_size=page_size, entity=entity, portal=portal):
+            ids = [r.id for r in results]
+            for i in range(0, len(ids), BATCH_READ_SIZE):
+                pending.append(executor.submit(batch_read, read, input_cls, ids[i:i + BATCH_READ_SIZE], props,
+                                               entity, portal))
+            yield from drain(max_in_flight)
+        yield from drain(0)
+    finally:
+        for future in pending:
+            future.cancel()
+
+    if total:
+        logger.info(f"⚡ {total} {label} obtenidos.")
+    else:
+        logger.info(f"⚠️ No se encontraron {label}.")
+
+
+def id_range_filters(id_range):
+    """Filtros de un rango [desde, hasta) de hs_object_id; un extremo None queda abierto."""
+    if id_range is None:
         return []
-
-
-# -------------------- ENGAGEMENTS --------------------
-def get_engagements_batch(limit=10000):
-    client = get_hubspot_client()
-    PROPS = ["hs_email_direction", "hs_timestamp", "hs_from_email", "hs_to_email", "hs_subject", "hs_object_id"]
+    low, high = id_range
+    filters = []
+    if low is not None:
+        filters.append({"propertyName": "hs_object_id", "operator": "GTE", "value": str(low)})
+    if high is not None:
+        filters.append({"propertyName": "hs_object_id", "operator": "LT", "value": str(high)})
+    return filters
+
+
+def match_filters(match):
+    """Filtros EQ fijos de una entidad (p. ej. leads: lifecyclestage = lead)."""
+    return [{"propertyName": k, "operator": "EQ", "value": v} for k, v in (match or {}).items()]
+
+
+def entity_filters(entity, since=None, id_range=None):
+    """Filtros de búsqueda de una entidad: modificados desde `since`, match fijo y rango de IDs."""
+    return (
+        (modified_since_filters(entity.modified_property, since) or [])
+        + match_filters(entity.match)
+        + id_range_filters(id_range)
+    )
+
+
+def get_id_bounds(name, since=None, portal=None):
+    """Total de registros a sincronizar y sus hs_object_id mínimo y máximo (dos búsquedas de 1 resultado)."""
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+    filters = entity_filters(entity, since)
+    ObjectSearchRequest, _ = object_models()
+
+    def first(direction):
+        search_request = ObjectSearchRequest(
+            limit=1,
+            properties=["hs_object_id"],
+            sorts=[{"propertyName": "hs_object_id", "direction": direction}],
+            filter_groups=[{"filters": filters}] if filters else None,
+        )
+        api = cached_api(client, "crm.objects.search_api")
+        return call_hubspot(api.do_search, portal=portal, search=True, entity=name, stage="search",
+                            object_type=entity.object_type, public_object_search_request=search_request)
+
+    lowest = first("ASCENDING")
+    if not lowest.results:
+        return 0, None, None
+    highest = first("DESCENDING")
+    return lowest.total, int(lowest.results[0].id), int(highest.results[0].id)
+
+
+def get_entity_batch(name, page_size=SEARCH_PAGE_SIZE, since=None, id_range=None, after_id=None, portal=None):
+    """Genera páginas de registros de una entidad del registro (Search + Batch Read de crm.objects).
+
+    `id_range` limita la descarga a un rango de hs_object_id (un shard del modo --workers);
+    `after_id` la retoma desde un checkpoint (solo IDs mayores).
+    """
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+    filters = entity_filters(entity, since, id_range)
+    if after_id is not None:
+        filters.append({"propertyName": "hs_object_id", "operator": "GT", "value": str(after_id)})
+
+    def do_search(**kwargs):
+        api = cached_api(client, "crm.objects.search_api")
+        response = api.do_search(object_type=entity.object_type, **kwargs)
+        metrics.incr(entity.name, "bytes_received", response_bytes(api))
+        return response
+
+    def read(**kwargs):
+        api = cached_api(client, "crm.objects.batch_api")
+        response = api.read(object_type=entity.object_type, **kwargs)
+        metrics.incr(entity.name, "bytes_received", response_bytes(api))
+        return response
 
     try:
-        logger.info("📡 Obteniendo lista de IDs de emails...")
-        search_request = ObjectSearchRequest(limit=limit, properties=["hs_object_id"])
-        search = client.crm.objects.search_api.do_search(object_type="emails", public_object_search_request=search_request)
-
-        email_ids = [r.id for r in search.results]
-
-        if not email_ids:
-            logger.info("⚠️ No se encontraron emails.")
-            return []
-
-        batch_input = ObjectBatchInput(inputs=[{"id": eid} for eid in email_ids])
-        response = client.crm.objects.batch_api.read(
-            object_type="emails",
-            batch_read_input_simple_public_object_id=batch_input,
-            properties=PROPS
+        logger.info(f"📡 Obteniendo lista de IDs de {entity.label}...")
+        yield from extract_pages(
+            entity.label,
+            do_search,
+            read,
+            *object_models(),
+            fetch_properties(entity, portal),
+            filters=filters or None,
+            page_size=page_size,
+            entity=entity.name,
+            portal=portal,
         )
 
-        results = response.results
-        logger.info(f"⚡ {len(results)} emails obtenidos.")
-        if results:
-            logger.debug(f"📋 Ejemplo: {results[0].properties}")
-        return results
+    except Exception as e:
+        if is_api_exception(e):
+            logger.error(f"❌ Error al obtener {entity.label} (Batch Read): {e}")
+        raise
+
+
+def read_associations(get_page, ids, entity=None, portal=None):
+    """Lee las asociaciones de un bloque de IDs siguiendo la paginación de cada objeto de origen.
+
+    Devuelve tuplas (from_id, to_id, type_id, category, label), una por tipo de asociación.
+    """
+    from hubspot.crm.associations.v4 import BatchInputPublicFetchAssociationsBatchRequest as AssociationBatchInput
+
+    rows = []
+    inputs = [{"id": oid} for oid in ids]
+    while inputs:
+        response = call_hubspot(get_page, portal=portal, entity=entity, stage="associations",
+                                batch_input_public_fetch_associations_batch_request=AssociationBatchInput(inputs=inputs))
+        inputs = []
+        for result in response.results or []:
+            from_id = str(result._from.id)
+            for to in result.to or []:
+                for spec in to.association_types or []:
+                    rows.append((from_id, str(to.to_object_id), spec.type_id, spec.category, spec.label))
+            after = result.paging.next.after if result.paging and result.paging.next else None
+            if after:
+                inputs.append({"id": from_id, "after": after})
+    return rows
+
+
+def get_associations(from_type, to_type, ids, entity=None, portal=None):
+    """Asociaciones de `ids` (objetos `from_type`) con objetos `to_type` vía el batch read v4.
+
+    Los IDs se leen en bloques de ASSOCIATIONS_BATCH_SIZE en paralelo, así que N objetos
+    cuestan N/1000 llamadas en vez de una por objeto.
+    """
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+
+    def get_page(**kwargs):
+        api = cached_api(client, "crm.associations.v4.batch_api")
+        response = api.get_page(from_object_type=from_type, to_object_type=to_type, **kwargs)
+        metrics.incr(entity, "bytes_received", response_bytes(api))
+        return response
 
-    except ObjectsApiException as e:
-        logger.error(f"❌ Error al obtener emails (Batch Read): {e}")
-        return []
+    try:
+        futures = [
+            get_executor(portal).submit(read_associations, get_page, ids[i:i + ASSOCIATIONS_BATCH_SIZE], entity, portal)
+            for i in range(0, len(ids), ASSOCIATIONS_BATCH_SIZE)
+        ]
+        rows = [row for future in futures for row in future.result()]
+    except Exception as e:
+        if is_api_exception(e):
+            logger.error(f"❌ Error al obtener asociaciones {from_type} → {to_type}: {e}")
+        raise
+    metrics.incr(entity, "records_received", len(rows))
+    return rows
+
+
+def get_archived_pages(name, page_size=SEARCH_PAGE_SIZE, portal=None):
+    """Genera páginas de (hs_object_id, archived_at) del listado de archivados de una entidad."""
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+    api = cached_api(client, "crm.objects.basic_api")
+    after = None
+    while True:
+        response = call_hubspot(api.get_page, portal=portal, entity=name, stage="archived",
+                                object_type=entity.object_type, limit=page_size, after=after,
+                                properties=["hs_object_id"], archived=True)
+        if response.results:
+            yield [(r.id, r.archived_at) for r in response.results]
+        paging_next = response.paging.next if response.paging else None
+        if not paging_next or not paging_next.after:
+            return
+        after = paging_next.after
+
+
+def get_id_pages(name, page_size=SEARCH_PAGE_SIZE, portal=None):
+    """Genera páginas de (hs_object_id,) de todos los registros vivos de una entidad (solo búsqueda)."""
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+
+    def do_search(**kwargs):
+        return cached_api(client, "crm.objects.search_api").do_search(object_type=entity.object_type, **kwargs)
+
+    filters = entity_filters(entity)
+    ObjectSearchRequest, _ = object_models()
+    for results in iter_search_pages(do_search, ObjectSearchRequest, filters=filters or None,
+                                     page_size=page_size, entity=name, portal=portal):
+        yield [(r.id,) for r in results]
+
+
+def get_records_by_id(name, ids, portal=None):
+    """Lee por ID los registros de una entidad (batch read, bloques en paralelo); los que no
+    vuelven están archivados o borrados en HubSpot. Para eventos sueltos, p. ej. webhooks.
+    """
+    entity = get_entity(name)
+    portal = get_portal(portal)
+    client = get_hubspot_client(portal)
+
+    def read(**kwargs):
+        api = cached_api(client, "crm.objects.batch_api")
+        response = api.read(object_type=entity.object_type, **kwargs)
+        metrics.incr(name, "bytes_received", response_bytes(api))
+        return response
+
+    properties = fetch_properties(entity, portal)
+    _, ObjectBatchInput = object_models()
+    futures = [
+        get_executor(portal).submit(batch_read, read, ObjectBatchInput, ids[i:i + BATCH_READ_SIZE], properties,
+                                    name, portal)
+        for i in range(0, len(ids), BATCH_READ_SIZE)
+    ]
+    records = [record for future in futures for record in future.result()]
+    metrics.incr(name, "records_received", len(records))
+    return records
+
+
+def get_contacts_batch(page_size=SEARCH_PAGE_SIZE, since=None):
+    return get_entity_batch("contacts", page_size, since)
+
+
+def get_deals_batch(page_size=SEARCH_PAGE_SIZE, since=None):
+    return get_entity_batch("deals", page_size, since)
+
+
+def get_leads_batch(page_size=SEARCH_PAGE_SIZE, since=None):
+    """Solo leads, filtrando en la búsqueda. La sync principal los deriva de get_contacts_batch."""
+    return get_entity_batch("leads", page_size, since)
+
+
+def get_engagements_batch(page_size=SEARCH_PAGE_SIZE, since=None):
+    return get_entity_batch("engagements", page_size, since)
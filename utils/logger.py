@@ -2,10 +2,21 @@ import logging
 import os
 
 LOG_DIR = "data/logs"
-os.makedirs(LOG_DIR, exist_ok=True)
+
+
+class LazyFileHandler(logging.FileHandler):
+    """FileHandler que crea la carpeta y abre el archivo con el primer mensaje, no al importar."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
 
 logging.basicConfig(
-    filename=os.path.join(LOG_DIR, "app.log"),
+    handlers=[LazyFileHandler(os.path.join(LOG_DIR, "app.log"))],
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from utils.logger import logger
+
+METRICS_REPORT_PATH = os.getenv("METRICS_REPORT_PATH", "data/metrics/run_report.json")
+# Textfile para el collector de node_exporter (opcional)
+METRICS_PROMETHEUS_PATH = os.getenv("METRICS_PROMETHEUS_PATH")
+
+_lock = threading.Lock()
+_counters = defaultdict(int)                   # (entidad, métrica) -> valor
+_stages = defaultdict(lambda: [0, 0.0])        # (entidad, etapa) -> [veces, segundos]
+_started_at = datetime.now(timezone.utc)
+
+
+def incr(entity, metric, value=1):
+    """Suma `value` a un contador de la entidad."""
+    with _lock:
+        _counters[(entity, metric)] += value
+
+
+def observe(entity, stage, seconds):
+    """Registra una ejecución de una etapa y su duración."""
+    with _lock:
+        entry = _stages[(entity, stage)]
+        entry[0] += 1
+        entry[1] += seconds
+
+
+@contextmanager
+def timed(entity, stage):
+    """Mide el bloque como una ejecución de `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(entity, stage, time.perf_counter() - start)
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _counters.clear()
+        _stages.clear()
+        _started_at = datetime.now(timezone.utc)
+
+
+def snapshot():
+    """Métricas acumuladas por entidad: contadores y etapas (veces y segundos)."""
+    entities = defaultdict(lambda: {"counters": {}, "stages": {}})
+    with _lock:
+        for (entity, metric), value in _counters.items():
+            entities[entity or "_"]["counters"][metric] = value
+        for (entity, stage), (count, seconds) in _stages.items():
+            entities[entity or "_"]["stages"][stage] = {"count": count, "seconds": round(seconds, 6)}
+    return dict(entities)
+
+
+def merge(entities):
+    """Suma a las métricas de este proceso un snapshot() de otro (p. ej. de un worker)."""
+    with _lock:
+        for entity, data in entities.items():
+            key = None if entity == "_" else entity
+            for metric, value in data["counters"].items():
+                _counters[(key, metric)] += value
+            for stage, values in data["stages"].items():
+                entry = _stages[(key, stage)]
+                entry[0] += values["count"]
+                entry[1] += values["seconds"]
+
+
+def write_run_report(path=METRICS_REPORT_PATH, extra=None):
+    """Escribe el reporte JSON de la corrida (y el textfile de Prometheus si está configurado)."""
+    finished_at = datetime.now(timezone.utc)
+    report = {
+        "started_at": _started_at.isoformat(),
+        "finished_at": finished_at.isoformat(),
+        "duration_seconds": round((finished_at - _started_at).total_seconds(), 3),
+        "entities": snapshot(),
+        **(extra or {}),
+    }
+    _write_atomic(path, json.dumps(report, indent=2, ensure_ascii=False, default=str))
+    logger.info(f"📈 Reporte de métricas escrito en {path}")
+    if METRICS_PROMETHEUS_PATH:
+        write_prometheus_textfile(METRICS_PROMETHEUS_PATH, report)
+    return report
+
+
+def write_prometheus_textfile(path, report=None):
+    """Exporta las métricas en formato de texto de Prometheus."""
+    report = report or {"entities": snapshot(), "finished_at": datetime.now(timezone.utc).isoformat()}
+    lines = [
+        "# HELP hubspot_sync_stage_seconds_total Segundos acumulados por etapa.",
+        "# TYPE hubspot_sync_stage_seconds_total counter",
+        "# HELP hubspot_sync_stage_runs_total Ejecuciones por etapa.",
+        "# TYPE hubspot_sync_stage_runs_total counter",
+    ]
+    for entity, data in sorted(report["entities"].items()):
+        for stage, values in sorted(data["stages"].items()):
+            labels = f'entity="{entity}",stage="{stage}"'
+            lines.append(f"hubspot_sync_stage_seconds_total{{{labels}}} {values['seconds']}")
+            lines.append(f"hubspot_sync_stage_runs_total{{{labels}}} {values['count']}")
+        for metric, value in sorted(data["counters"].items()):
+            lines.append(f'hubspot_sync_{metric}_total{{entity="{entity}"}} {value}')
+    finished = datetime.fromisoformat(report["finished_at"]).timestamp()
+    lines.append(f"hubspot_sync_last_run_timestamp_seconds {finished}")
+    _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path, content):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
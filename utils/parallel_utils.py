@@ -0,0 +1,129 @@
+import multiprocessing
+import os
+from datetime import datetime, timezone
+from utils import metrics
+from utils.batch_utils import log_batch_sizes
+from utils.db_utils import close_all_pools
+from utils.hubspot_utils import get_id_bounds, share_rate_limits
+from utils.state_db_utils import (
+    clear_checkpoints, get_checkpoints, parse_shard_key, save_checkpoint, shard_key, update_last_sync_time
+)
+from utils.sync_utils import sync_since
+from utils.logger import logger
+
+# Registros mínimos por shard: una entidad más chica se descarga entera en un solo proceso
+SYNC_SHARD_MIN_RECORDS = int(os.getenv("SYNC_SHARD_MIN_RECORDS", "20000"))
+
+
+def plan_shards(total, low, high, workers, min_records=SYNC_SHARD_MIN_RECORDS):
+    """Parte [low, high] de hs_object_id en hasta `workers` rangos [desde, hasta).
+
+    El primer y el último rango quedan abiertos para cubrir IDs creados durante la corrida.
+    """
+    count = max(1, min(workers, total // max(1, min_records)))
+    if count == 1 or low is None:
+        return [None]
+    edges = [low + (high - low + 1) * i // count for i in range(1, count)]
+    bounds = [None] + edges + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def plan_entity(name, workers, full=False, schema="hubspot", portal=None):
+    """Shards de una entidad y el inicio de su corrida: los de una corrida cortada o un reparto nuevo.
+
+    Un reparto nuevo deja un checkpoint vacío por shard, así una corrida que se corta antes
+    de que algún shard arranque igual se retoma con los mismos rangos.
+    Devuelve (inicio, [(peso, rango)]).
+    """
+    checkpoints = get_checkpoints(name, schema)
+    if full and any(c["since"] is not None for c in checkpoints.values()):
+        checkpoints = {}    # una corrida --full no retoma una incremental
+    if checkpoints:
+        logger.info(f"⏯️ {name}: retomando {len(checkpoints)} shard(s) de la corrida anterior")
+        started = min(c["started_at"] for c in checkpoints.values())
+        return started, [(0, parse_shard_key(key)) for key in checkpoints]
+
+    clear_checkpoints(name, schema)
+    started = datetime.now(timezone.utc)
+    since = sync_since(name, schema, full)
+    total, low, high = get_id_bounds(name, since, portal)
+    ranges = plan_shards(total, low, high, workers)
+    for id_range in ranges:
+        save_checkpoint(name, shard_key(id_range), None, since, started, schema)
+    logger.info(f"🧩 {name}: {total} registros en {len(ranges)} shard(s)")
+    return started, [(total / len(ranges), id_range) for id_range in ranges]
+
+
+def _init_worker(workers):
+    share_rate_limits(workers)
+
+
+def _run_shard(job, name, id_range, full):
+    """Corre un shard en el proceso worker; devuelve sus conteos y sus métricas."""
+    metrics.reset()
+    try:
+        totals = job(name, full=full, id_range=id_range, update_watermarks=False)
+    except Exception as e:
+        # Las excepciones del SDK no siempre se pueden picklear de vuelta al coordinador
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    finally:
+        close_all_pools()
+        log_batch_sizes()
+    return totals, metrics.snapshot()
+
+
+def run_sharded(job, roots, full=False, workers=2, schema="hubspot", portal=None):
+    """Sincroniza las entidades de un portal en `workers` procesos, partiendo las grandes por rangos
+    de hs_object_id.
+
+    `job(name, full, id_range, update_watermarks)` sincroniza un shard (ver main.sync_job) y
+    debe poder picklearse (p. ej. un partial con el nombre del portal).
+    Cada proceso tiene su propio pool de conexiones y 1/workers del rate limit. Los
+    watermarks de una entidad y de sus derivadas se escriben acá (y se borran sus
+    checkpoints), solo si todos sus shards terminaron bien. Devuelve los conteos por
+    entidad y los errores por entidad raíz.
+    """
+    started, shards, errors = {}, [], {}
+    for entity in roots:
+        try:
+            started[entity.name], weighted = plan_entity(entity.name, workers, full, schema, portal)
+        except Exception as e:
+            errors[entity.name] = [str(e)]
+            logger.error(f"❌ No se pudo planificar {entity.name}: {e}")
+            continue
+        shards.extend((weight, entity.name, id_range) for weight, id_range in weighted)
+    # Los shards más grandes primero, para que el último en terminar sea uno chico
+    shards.sort(key=lambda shard: shard[0], reverse=True)
+
+    totals = {}
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(workers,)) as pool:
+        pending = [
+            (name, id_range, pool.apply_async(_run_shard, (job, name, id_range, full)))
+            for _, name, id_range in shards
+        ]
+        for name, id_range, result in pending:
+            try:
+                shard_totals, snapshot = result.get()
+            except Exception as e:
+                errors.setdefault(name, []).append(f"{id_range}: {e}")
+                logger.error(f"❌ Falló el shard {id_range} de {name}: {e}")
+                continue
+            metrics.merge(snapshot)
+            for sink, stats in shard_totals.items():
+                merged = totals.setdefault(name, {}).setdefault(sink, dict.fromkeys(stats, 0))
+                for key, value in stats.items():
+                    merged[key] += value
+        pool.close()
+        pool.join()
+
+    results = {}
+    for name, sinks in totals.items():
+        if name in errors:
+            logger.warning(f"⚠️ {name}: hubo shards con error; no se actualizan sus watermarks")
+            continue
+        for sink, stats in sinks.items():
+            update_last_sync_time(sink, schema, sync_time=started[name])
+            results[sink] = stats
+        clear_checkpoints(name, schema)
+    return results, errors
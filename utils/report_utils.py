@@ -0,0 +1,236 @@
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from utils import metrics
+from utils.db_utils import db_connection
+from utils.logger import logger
+
+# Más grupos tocados que esto en una corrida: se recalcula el resumen entero
+REPORT_MAX_TOUCHED_GROUPS = int(os.getenv("REPORT_MAX_TOUCHED_GROUPS", "5000"))
+
+_touched = {}          # (schema, resumen) -> grupos tocados
+_touched_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Key:
+    """Columna de agrupación de un resumen: una columna de la tabla origen o su mes (UTC)."""
+    name: str
+    sql_type: str
+    column: str
+    month: bool = False
+
+    @property
+    def expression(self):
+        if self.month:
+            return f"date_trunc('month', t.{self.column} AT TIME ZONE 'UTC')::date"
+        return f"t.{self.column}"
+
+
+@dataclass(frozen=True)
+class Summary:
+    """Tabla de resumen para BI, mantenida por grupos a partir de una tabla sincronizada."""
+    name: str
+    source: str
+    keys: tuple
+    measures: tuple        # (columna, tipo SQL, agregado sobre la tabla origen)
+
+    @property
+    def key_names(self):
+        return [k.name for k in self.keys]
+
+
+DEALS_BY_STAGE_MONTH = Summary(
+    name="report_deals_by_stage_month",
+    source="deals",
+    keys=(
+        Key("pipeline", "VARCHAR(100)", "pipeline"),
+        Key("dealstage", "VARCHAR(100)", "dealstage"),
+        Key("close_month", "DATE", "closedate", month=True),
+    ),
+    measures=(
+        ("deals", "BIGINT", "count(*)"),
+        ("amount", "NUMERIC(17,2)", "sum(t.amount)"),
+    ),
+)
+
+EMAILS_BY_DIRECTION_MONTH = Summary(
+    name="report_emails_by_direction_month",
+    source="engagements",
+    keys=(
+        Key("direction", "VARCHAR(20)", "hs_email_direction"),
+        Key("month", "DATE", "hs_timestamp", month=True),
+    ),
+    measures=(
+        ("emails", "BIGINT", "count(*)"),
+        ("senders", "BIGINT", "count(DISTINCT t.hs_from_email)"),
+    ),
+)
+
+CONTACTS_BY_STAGE_MONTH = Summary(
+    name="report_contacts_by_stage_month",
+    source="contacts",
+    keys=(
+        Key("created_month", "DATE", "createdate", month=True),
+        Key("lifecyclestage", "VARCHAR(50)", "lifecyclestage"),
+    ),
+    measures=(
+        ("contacts", "BIGINT", "count(*)"),
+    ),
+)
+
+SUMMARIES = {s.name: s for s in (DEALS_BY_STAGE_MONTH, EMAILS_BY_DIRECTION_MONTH, CONTACTS_BY_STAGE_MONTH)}
+
+
+def summaries_for(tables):
+    """Resúmenes que salen de alguna de las tablas dadas."""
+    return [s for s in SUMMARIES.values() if s.source in tables]
+
+
+def init_report_tables(schema="hubspot"):
+    """Crea las tablas de resumen y el índice por su clave de grupo."""
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        for summary in SUMMARIES.values():
+            columns = [f"{k.name} {k.sql_type}" for k in summary.keys]
+            columns += [f"{name} {sql_type}" for name, sql_type, _ in summary.measures]
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {summary.name} (
+                    {", ".join(columns)},
+                    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS {summary.name}_key_idx ON {summary.name} ({", ".join(summary.key_names)});
+            """)
+        conn.commit()
+    logger.info(f"✅ Tablas de reportes verificadas o creadas ({len(SUMMARIES)}).")
+
+
+def capture_keys(cursor, table, ids, schema="hubspot"):
+    """Anota los grupos de los resúmenes de `table` (en `schema`) a los que pertenecen las filas de `ids`.
+
+    Se llama antes y después de escribir las filas: así se recalculan tanto el grupo
+    que una fila deja (p. ej. un deal que cambia de etapa) como el que gana.
+    """
+    summaries = summaries_for({table})
+    if not summaries or not ids:
+        return
+    for summary in summaries:
+        expressions = ", ".join(k.expression for k in summary.keys)
+        cursor.execute(
+            f"SELECT DISTINCT {expressions} FROM {table} t WHERE t.hs_object_id = ANY(%s::bigint[]);",
+            ([int(i) for i in ids],),
+        )
+        keys = cursor.fetchall()
+        with _touched_lock:
+            _touched.setdefault((schema, summary.name), set()).update(keys)
+
+
+def _key_filter(key, values):
+    """Filtro indexable sobre la tabla origen que cubre los valores tocados de una clave."""
+    present = [v for v in values if v is not None]
+    conditions, params = [], []
+    if present and key.month:
+        conditions.append(f"(t.{key.column} >= %s AND t.{key.column} < %s)")
+        last = max(present)
+        params += [
+            datetime.combine(min(present), datetime.min.time(), timezone.utc),
+            datetime(last.year + last.month // 12, last.month % 12 + 1, 1, tzinfo=timezone.utc),
+        ]
+    elif present:
+        conditions.append(f"t.{key.column} = ANY(%s)")
+        params.append(present)
+    if len(present) < len(values):
+        conditions.append(f"t.{key.column} IS NULL")
+    return f"({' OR '.join(conditions)})", params
+
+
+def _select_groups(summary):
+    keys = ", ".join(f"{k.expression} AS {k.name}" for k in summary.keys)
+    measures = ", ".join(expression for _, _, expression in summary.measures)
+    return f"SELECT {keys}, {measures} FROM {summary.source} t WHERE t.archived_at IS NULL"
+
+
+def _group_by(summary):
+    return ", ".join(str(i) for i in range(1, len(summary.keys) + 1))
+
+
+def _insert_columns(summary):
+    return ", ".join(summary.key_names + [name for name, _, _ in summary.measures])
+
+
+def rebuild_summary(cursor, summary):
+    """Recalcula un resumen entero; DELETE + INSERT en una transacción, sin bloquear a los lectores."""
+    cursor.execute(f"DELETE FROM {summary.name};")
+    cursor.execute(f"""
+        INSERT INTO {summary.name} ({_insert_columns(summary)})
+        {_select_groups(summary)}
+        GROUP BY {_group_by(summary)};
+    """)
+    return cursor.rowcount
+
+
+def refresh_groups(cursor, summary, keys):
+    """Recalcula solo los grupos `keys` de un resumen; devuelve cuántos grupos quedaron con filas."""
+    columns = list(zip(*keys))
+    filters, params = [], []
+    for key, values in zip(summary.keys, columns):
+        condition, condition_params = _key_filter(key, set(values))
+        filters.append(condition)
+        params += condition_params
+    types = [f"%s::{k.sql_type.split('(')[0]}[]" for k in summary.keys]
+    touched = f"unnest({', '.join(types)}) AS k({', '.join(summary.key_names)})"
+    match = " AND ".join(f"g.{name} IS NOT DISTINCT FROM k.{name}" for name in summary.key_names)
+    arrays = [list(values) for values in columns]
+
+    cursor.execute(f"DELETE FROM {summary.name} g USING {touched} WHERE {match};", arrays)
+    cursor.execute(f"""
+        INSERT INTO {summary.name} ({_insert_columns(summary)})
+        SELECT g.* FROM (
+            {_select_groups(summary)} AND {" AND ".join(filters)}
+            GROUP BY {_group_by(summary)}
+        ) g
+        WHERE EXISTS (SELECT 1 FROM {touched} WHERE {match});
+    """, params + arrays)
+    return cursor.rowcount
+
+
+def refresh_summaries(tables, schema="hubspot", rebuild=False):
+    """Actualiza los resúmenes de `tables` en los grupos tocados en esta corrida.
+
+    Un resumen vacío (recién creado), con más de REPORT_MAX_TOUCHED_GROUPS grupos tocados
+    o con rebuild=True se recalcula entero. Cada resumen se actualiza en su propia
+    transacción, serializada con un advisory lock por schema y resumen entre procesos (p. ej.
+    shards de --workers); los portales no se bloquean entre sí.
+    """
+    results = {}
+    for summary in summaries_for(tables):
+        with _touched_lock:
+            keys = _touched.pop((schema, summary.name), set())
+        with db_connection(schema) as conn, conn.cursor() as cursor:
+            try:
+                with metrics.timed(summary.name, "report_refresh"):
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"{schema}.{summary.name}",))
+                    cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {summary.name});")
+                    empty = cursor.fetchone()[0]
+                    if rebuild or empty or len(keys) > REPORT_MAX_TOUCHED_GROUPS:
+                        groups = rebuild_summary(cursor, summary)
+                        mode = "completo"
+                    elif keys:
+                        groups = refresh_groups(cursor, summary, keys)
+                        mode = f"{len(keys)} grupos tocados"
+                    else:
+                        conn.rollback()
+                        continue
+                    conn.commit()
+            except Exception as e:
+                conn.rollback()
+                with _touched_lock:
+                    # Quedan pendientes para el próximo refresh de este proceso
+                    _touched.setdefault((schema, summary.name), set()).update(keys)
+                metrics.incr(summary.name, "report_errors")
+                logger.error(f"❌ Error actualizando el reporte {summary.name}: {e}")
+                continue
+        metrics.incr(summary.name, "report_groups", groups)
+        results[summary.name] = groups
+        logger.info(f"📊 Reporte {schema}.{summary.name} actualizado ({mode}, {groups} grupos con datos)")
+    return results
@@ -1,33 +1,82 @@
-from utils.db_utils import get_db_connection
+from utils.db_utils import db_connection
 from datetime import datetime, timezone
 from utils.logger import logger
 
 def get_last_sync_time(entity, schema="hubspot"):
     """Obtiene la última fecha de sincronización de una entidad."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_sync FROM sync_status WHERE entity = %s;", (entity,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT last_sync FROM sync_status WHERE entity = %s;", (entity,))
+        result = cursor.fetchone()
     if result and result[0]:
         logger.info(f"🕒 Última sync de {entity}: {result[0]}")
-        return result[0]
+        # last_sync se guarda en UTC sin zona horaria
+        return result[0].replace(tzinfo=timezone.utc)
     return None
 
 
-def update_last_sync_time(entity, schema="hubspot"):
-    """Actualiza o inserta la fecha actual como última sincronización."""
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-    now = datetime.now(timezone.utc)
-    cursor.execute("""
-        INSERT INTO sync_status (entity, last_sync)
-        VALUES (%s, %s)
-        ON CONFLICT (entity)
-        DO UPDATE SET last_sync = EXCLUDED.last_sync;
-    """, (entity, now))
-    conn.commit()
-    cursor.close()
-    conn.close()
+def update_last_sync_time(entity, schema="hubspot", sync_time=None):
+    """Actualiza o inserta la última sincronización (por defecto, la fecha actual)."""
+    now = sync_time or datetime.now(timezone.utc)
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO sync_status (entity, last_sync)
+            VALUES (%s, %s AT TIME ZONE 'UTC')
+            ON CONFLICT (entity)
+            DO UPDATE SET last_sync = EXCLUDED.last_sync;
+        """, (entity, now))
+        conn.commit()
     logger.info(f"🕒 Timestamp de sync actualizado para {entity}: {now.isoformat()}")
+
+
+# ---------- CHECKPOINTS (reanudar una corrida cortada) ----------
+def shard_key(id_range=None):
+    """Clave de checkpoint de un rango de hs_object_id: "all", "-20001", "20001-40001", "40001-"."""
+    if id_range is None:
+        return "all"
+    low, high = id_range
+    return f"{'' if low is None else low}-{'' if high is None else high}"
+
+
+def parse_shard_key(key):
+    """Inversa de shard_key."""
+    if key == "all":
+        return None
+    low, high = key.split("-")
+    return (int(low) if low else None, int(high) if high else None)
+
+
+def _utc(value):
+    return value.replace(tzinfo=timezone.utc) if value else None
+
+
+def get_checkpoints(entity, schema="hubspot"):
+    """Checkpoints pendientes de una entidad: {shard: {"last_id", "since", "started_at"}}."""
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT shard, last_id, since, started_at FROM sync_checkpoints WHERE entity = %s;", (entity,)
+        )
+        rows = cursor.fetchall()
+    return {
+        shard: {"last_id": last_id, "since": _utc(since), "started_at": _utc(started_at)}
+        for shard, last_id, since, started_at in rows
+    }
+
+
+def save_checkpoint(entity, shard, last_id, since, started_at, schema="hubspot"):
+    """Guarda el último hs_object_id confirmado en la base de un shard (None: aún sin páginas)."""
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO sync_checkpoints (entity, shard, last_id, since, started_at, updated_at)
+            VALUES (%s, %s, %s, %s AT TIME ZONE 'UTC', %s AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC')
+            ON CONFLICT (entity, shard)
+            DO UPDATE SET last_id = EXCLUDED.last_id, since = EXCLUDED.since,
+                          started_at = EXCLUDED.started_at, updated_at = EXCLUDED.updated_at;
+        """, (entity, shard, last_id, since, started_at))
+        conn.commit()
+
+
+def clear_checkpoints(entity, schema="hubspot"):
+    """Borra los checkpoints de una entidad una vez que su corrida terminó bien."""
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("DELETE FROM sync_checkpoints WHERE entity = %s;", (entity,))
+        conn.commit()
@@ -1,9 +1,40 @@
+import hashlib
+import json
+import os
+import queue
+import threading
 import time
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from io import StringIO
 from psycopg2.extras import execute_values
-from utils.db_utils import get_db_connection
+from utils import metrics
+from utils.batch_utils import BatchSizer, batch_sizer
+from utils.cache_utils import RAW_CACHE, cache_key, cache_pages
+from utils.db_utils import db_connection, ensure_month_partitions
+from utils.entities import extra_property_setting, get_entity
+from utils.report_utils import capture_keys
+from utils.state_db_utils import (
+    clear_checkpoints, get_checkpoints, get_last_sync_time, save_checkpoint, update_last_sync_time
+)
 from utils.logger import logger
 
+# Margen que se resta al watermark para cubrir desfases de reloj con HubSpot
+SYNC_OVERLAP = timedelta(minutes=int(os.getenv("SYNC_OVERLAP_MINUTES", "10")))
+
+# Modo de carga por defecto: "copy" (COPY a tabla temporal + merge) o "values" (execute_values)
+LOADER_MODE = os.getenv("LOADER_MODE", "copy")
+
+# Pipeline: descarga y escritura en paralelo, con a lo sumo SYNC_QUEUE_PAGES páginas en cola
+SYNC_PIPELINE = os.getenv("SYNC_PIPELINE", "1") == "1"
+SYNC_QUEUE_PAGES = int(os.getenv("SYNC_QUEUE_PAGES", "8"))
+# Registros por bloque por defecto (la sync y el replay usan el tamaño de lote adaptativo de batch_utils)
+SYNC_FLUSH_SIZE = 10000
+
+# Descarta en memoria las filas cuyo hash ya está en la base antes de enviarlas (opcional)
+SYNC_HASH_PREFILTER = os.getenv("SYNC_HASH_PREFILTER", "0") == "1"
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
 
 def parse_date(date_str):
     """Convierte fechas ISO 8601 (de HubSpot) a datetime."""
@@ -15,193 +46,680 @@ def parse_date(date_str):
         return None
 
 
-def bulk_insert(cursor, query, data, batch_size=10000):
-    """Inserta datos en lotes grandes usando execute_values."""
-    total = len(data)
-    for i in range(0, total, batch_size):
-        batch = data[i:i + batch_size]
-        execute_values(cursor, query, batch, page_size=batch_size)
-    return total
+_hash_indexes = {}
+_hash_indexes_lock = threading.Lock()
 
 
-# ---------- CONTACTOS ----------
-def save_contacts_to_db(contacts, schema="hubspot"):
-    start = time.time()
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-
-    query = """
-        INSERT INTO contacts (hs_object_id, firstname, lastname, email, phone, createdate, lastmodifieddate)
-        VALUES %s
-        ON CONFLICT (hs_object_id) DO UPDATE
-        SET firstname = EXCLUDED.firstname,
-            lastname = EXCLUDED.lastname,
-            email = EXCLUDED.email,
-            phone = EXCLUDED.phone,
-            lastmodifieddate = EXCLUDED.lastmodifieddate;
+def bulk_insert(cursor, query, data, sizer=None):
+    """Inserta datos en lotes usando execute_values; devuelve (insertados, actualizados).
+
+    Cada lote es un solo statement del tamaño que indica `sizer` (ver batch_utils.BatchSizer).
     """
+    sizer = sizer or BatchSizer()
+    inserted = updated = 0
+    i = 0
+    while i < len(data):
+        batch = data[i:i + sizer.size()]
+        start = time.perf_counter()
+        for (was_inserted,) in execute_values(cursor, query, batch, page_size=len(batch), fetch=True):
+            if was_inserted:
+                inserted += 1
+            else:
+                updated += 1
+        sizer.observe(len(batch), len(cursor.query or b""), time.perf_counter() - start)
+        i += len(batch)
+    return inserted, updated
 
-    data = [
-        (
-            c.properties.get("hs_object_id"),
-            c.properties.get("firstname"),
-            c.properties.get("lastname"),
-            c.properties.get("email"),
-            c.properties.get("phone"),
-            parse_date(c.properties.get("createdate")),
-            parse_date(c.properties.get("lastmodifieddate")),
-        )
-        for c in contacts
-        if c.properties.get("hs_object_id")
-    ]
 
-    try:
-        count = bulk_insert(cursor, query, data)
-        conn.commit()
-        logger.info(f"⚡ {count} contactos insertados/actualizados en {schema}.contacts ✅")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"❌ Error en bulk insert de contactos: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+def get_loader_mode(entity):
+    """Modo de carga de una entidad: LOADER_MODE_<ENTIDAD> o, si no existe, LOADER_MODE."""
+    return os.getenv(f"LOADER_MODE_{entity.upper()}", LOADER_MODE).lower()
 
-    logger.info(f"⏱️ Tiempo total contactos: {round(time.time() - start, 2)}s")
 
+def build_upsert_query(table, columns, update_columns, source="VALUES %s", conflict_key="hs_object_id",
+                       restore_archived=False, returning="(xmax = 0) AS inserted"):
+    """Arma el INSERT ... ON CONFLICT DO UPDATE de una tabla a partir de sus columnas.
 
-# ---------- DEALS ----------
-def save_deals_to_db(deals, schema="hubspot"):
-    start = time.time()
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-
-    query = """
-        INSERT INTO deals (hs_object_id, dealname, dealstage, pipeline, amount, closedate, createdate, lastmodifieddate)
-        VALUES %s
-        ON CONFLICT (hs_object_id) DO UPDATE
-        SET dealname = EXCLUDED.dealname,
-            dealstage = EXCLUDED.dealstage,
-            pipeline = EXCLUDED.pipeline,
-            amount = EXCLUDED.amount,
-            closedate = EXCLUDED.closedate,
-            lastmodifieddate = EXCLUDED.lastmodifieddate;
+    Solo reescribe filas cuyo row_hash cambió y devuelve, por fila escrita, si fue un insert.
+    Con restore_archived, una fila archivada que vuelve a llegar de HubSpot se desarchiva.
+    Las tablas particionadas no exponen xmax: ahí se pasa otro `returning`.
+    """
+    assignments = [f"{col} = EXCLUDED.{col}" for col in update_columns]
+    condition = f"{table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"
+    if restore_archived:
+        assignments.append("archived_at = NULL")
+        condition += f" OR {table}.archived_at IS NOT NULL"
+    set_clause = ",\n            ".join(assignments)
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        {source}
+        ON CONFLICT ({conflict_key}) DO UPDATE
+        SET {set_clause}
+        WHERE {condition}
+        RETURNING {returning}
+    """
+
+
+def row_hash(row):
+    """Hash MD5 del contenido de una fila, usado para no reescribir filas sin cambios."""
+    content = "\x1f".join(_copy_value(v) for v in row)
+    return hashlib.md5(content.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+def get_hash_index(cursor, schema, table):
+    """Índice en memoria hs_object_id -> row_hash de una tabla, cargado una vez por proceso."""
+    key = (schema, table)
+    with _hash_indexes_lock:
+        if key not in _hash_indexes:
+            # Las filas archivadas quedan fuera: si vuelven, tienen que pasar para desarchivarse
+            cursor.execute(f"SELECT hs_object_id, row_hash FROM {table} WHERE archived_at IS NULL;")
+            _hash_indexes[key] = dict(cursor.fetchall())
+            logger.info(f"🧮 Índice de hashes de {schema}.{table} cargado ({len(_hash_indexes[key])} filas)")
+        return _hash_indexes[key]
+
+
+def forget_hash_index(schema, table):
+    """Descarta el índice de hashes (p. ej. tras un rollback) para recargarlo en el próximo uso."""
+    with _hash_indexes_lock:
+        _hash_indexes.pop((schema, table), None)
+
+
+def format_stats(stats):
+    return f"{stats['inserted']} nuevos, {stats['updated']} actualizados, {stats['unchanged']} sin cambios"
+
+
+def _copy_value(value):
+    """Serializa un valor al formato de texto de COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def dedupe_rows(rows, columns, key_columns):
+    """Deja una fila por clave, la última que llegó (la más nueva: páginas en orden, replay de
+    la completa a las incrementales), conservando el orden de la primera aparición."""
+    indexes = [columns.index(name) for name in key_columns]
+    latest = {}
+    for row in rows:
+        latest[tuple(row[i] for i in indexes)] = row
+    return list(latest.values()) if len(latest) < len(rows) else rows
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Copia filas a una tabla con COPY FROM STDIN (formato texto); devuelve el tamaño del buffer."""
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(v) for v in row))
+        buffer.write("\n")
+    size = buffer.tell()
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return size
+
+
+def copy_upsert(cursor, table, columns, update_columns, data, sizer=None, conflict_key="hs_object_id",
+                restore_archived=False, partitioned=False):
+    """Carga filas con COPY FROM STDIN a una tabla temporal y las fusiona con un único INSERT ... SELECT.
+
+    Cada lote se escribe en un buffer en memoria, se copia a la tabla de staging, se fusiona
+    con la tabla destino y se vacía el staging; `sizer` (batch_utils.BatchSizer) decide las
+    filas de cada lote a partir de los bytes y la duración de los anteriores.
+    En tablas particionadas los nuevos se cuentan antes del merge (las claves que no están).
+    """
+    sizer = sizer or BatchSizer()
+    staging = f"_staging_{table}"
+    column_list = ", ".join(columns)
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS
+        SELECT {column_list} FROM {table} WITH NO DATA;
+    """)
+    upsert = build_upsert_query(
+        table, columns, update_columns,
+        source=f"SELECT {column_list} FROM {staging}",
+        conflict_key=conflict_key,
+        restore_archived=restore_archived,
+        returning="1" if partitioned else "(xmax = 0) AS inserted",
+    )
+    if partitioned:
+        key_match = " AND ".join(f"t.{key} = s.{key}" for key in conflict_key.split(", "))
+        count_new = f"""
+            SELECT count(*) FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {key_match});
+        """
+        merge = f"WITH upserted AS ({upsert}) SELECT count(*) FROM upserted;"
+    else:
+        merge = f"""
+            WITH upserted AS ({upsert})
+            SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted;
+        """
+
+    inserted = updated = 0
+    i = 0
+    while i < len(data):
+        batch = data[i:i + sizer.size()]
+        start = time.perf_counter()
+        nbytes = copy_rows(cursor, staging, columns, batch)
+        if partitioned:
+            cursor.execute(count_new)
+            (batch_inserted,) = cursor.fetchone()
+            cursor.execute(merge)
+            batch_updated = cursor.fetchone()[0] - batch_inserted
+        else:
+            cursor.execute(merge)
+            batch_inserted, batch_updated = cursor.fetchone()
+        inserted += batch_inserted
+        updated += batch_updated
+        cursor.execute(f"TRUNCATE {staging};")
+        sizer.observe(len(batch), nbytes, time.perf_counter() - start)
+        i += len(batch)
+    return inserted, updated
+
+
+def upsert_rows(cursor, table, columns, update_columns, data, schema="hubspot", mode=None,
+                conflict_key="hs_object_id", restore_archived=False, partitioned=False):
+    """Upsert de filas con el loader de la entidad; devuelve conteos nuevos/actualizados/sin cambios.
+
+    Si una clave viene repetida en el bloque se guarda su última aparición (un ON CONFLICT no
+    puede tocar la misma fila dos veces). Agrega row_hash a cada fila; con SYNC_HASH_PREFILTER=1
+    las filas cuyo hash ya está en la base se descartan antes de enviarlas (solo tablas con clave
+    hs_object_id). Las tablas particionadas siempre se cargan con COPY. El tamaño de los lotes
+    lo adapta el BatchSizer de la tabla.
+    """
+    data = dedupe_rows(data, columns, conflict_key.split(", "))
+    rows = [row + (row_hash(row),) for row in data]
+    total = len(rows)
+    if SYNC_HASH_PREFILTER and conflict_key == "hs_object_id":
+        key_index = columns.index("hs_object_id")
+        index = get_hash_index(cursor, schema, table)
+        rows = [row for row in rows if index.get(row[key_index]) != row[-1]]
+        index.update((row[key_index], row[-1]) for row in rows)
+
+    columns = columns + ["row_hash"]
+    update_columns = update_columns + ["row_hash"]
+    sizer = batch_sizer(table, schema)
+    if partitioned or (mode or get_loader_mode(table)) == "copy":
+        inserted, updated = copy_upsert(cursor, table, columns, update_columns, rows, sizer=sizer,
+                                        conflict_key=conflict_key, restore_archived=restore_archived,
+                                        partitioned=partitioned)
+    else:
+        query = build_upsert_query(table, columns, update_columns, conflict_key=conflict_key,
+                                   restore_archived=restore_archived)
+        inserted, updated = bulk_insert(cursor, query, rows, sizer=sizer)
+    return {"inserted": inserted, "updated": updated, "unchanged": total - inserted - updated}
+
+
+def iter_chunks(pages, size=SYNC_FLUSH_SIZE):
+    """Agrupa páginas de registros en bloques de ~size para escribirlos por lotes.
+
+    `size` puede ser una función (p. ej. BatchSizer.size), que se consulta en cada bloque.
+    """
+    chunk = []
+    for page in pages:
+        chunk.extend(page)
+        if len(chunk) >= (size() if callable(size) else size):
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_END_OF_PAGES = object()
+
+
+def iter_pipelined(pages, max_pages=SYNC_QUEUE_PAGES, size=SYNC_FLUSH_SIZE):
+    """Descarga las páginas en un hilo productor y entrega bloques al consumidor a medida que llegan.
+
+    La cola acotada aplica backpressure: si la base se atrasa, el productor espera. Cada bloque
+    junta las páginas ya encoladas (hasta ~size registros), así que con una base rápida se
+    escribe página a página y con una lenta se escriben lotes más grandes. `size` puede ser
+    una función, como en iter_chunks.
     """
+    pipe = queue.Queue(maxsize=max_pages)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pipe.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    data = [
-        (
-            d.properties.get("hs_object_id"),
-            d.properties.get("dealname"),
-            d.properties.get("dealstage"),
-            d.properties.get("pipeline"),
-            float(d.properties.get("amount")) if d.properties.get("amount") else None,
-            parse_date(d.properties.get("closedate")),
-            parse_date(d.properties.get("createdate")),
-            parse_date(d.properties.get("lastmodifieddate")),
-        )
-        for d in deals
-        if d.properties.get("hs_object_id")
-    ]
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(_END_OF_PAGES)
+        except BaseException as e:
+            put(e)
+        finally:
+            close = getattr(pages, "close", None)
+            if close:
+                close()
 
+    producer = threading.Thread(target=produce, name="sync-producer", daemon=True)
+    producer.start()
     try:
-        count = bulk_insert(cursor, query, data)
-        conn.commit()
-        logger.info(f"⚡ {count} deals insertados/actualizados en {schema}.deals ✅")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"❌ Error en bulk insert de deals: {e}")
+        finished = False
+        while not finished:
+            chunk = []
+            limit = size() if callable(size) else size
+            item = pipe.get()
+            while True:
+                if item is _END_OF_PAGES:
+                    finished = True
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                chunk.extend(item)
+                if len(chunk) >= limit:
+                    break
+                try:
+                    item = pipe.get_nowait()
+                except queue.Empty:
+                    break
+            if chunk:
+                yield chunk
     finally:
-        cursor.close()
-        conn.close()
+        stop.set()
 
-    logger.info(f"⏱️ Tiempo total deals: {round(time.time() - start, 2)}s")
 
+def sync_since(entity, schema="hubspot", full=False):
+    """Desde cuándo descargar una entidad: su watermark menos SYNC_OVERLAP, o None (todo)."""
+    since = None if full else get_last_sync_time(entity, schema)
+    return since - SYNC_OVERLAP if since else None
 
-# ---------- LEADS ----------
-def save_leads_to_db(leads, schema="hubspot"):
-    start = time.time()
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-
-    query = """
-        INSERT INTO leads (hs_object_id, firstname, lastname, email, phone, lifecyclestage, createdate, lastmodifieddate)
-        VALUES %s
-        ON CONFLICT (hs_object_id) DO UPDATE
-        SET firstname = EXCLUDED.firstname,
-            lastname = EXCLUDED.lastname,
-            email = EXCLUDED.email,
-            phone = EXCLUDED.phone,
-            lifecyclestage = EXCLUDED.lifecyclestage,
-            lastmodifieddate = EXCLUDED.lastmodifieddate;
+
+def save_chunk(sinks, records, totals, schema="hubspot"):
+    """Reparte un bloque de registros entre los sinks (entidad y derivadas) y suma sus conteos."""
+    for name, predicate, sink_save in sinks:
+        subset = records if predicate is None else [r for r in records if predicate(r)]
+        if not subset:
+            continue
+        stats = sink_save(subset, schema=schema)
+        if stats is None:
+            raise RuntimeError(f"Falló el guardado de {name}; no se actualiza el watermark")
+        for key in stats:
+            totals[name][key] += stats[key]
+
+
+def sync_entity(entity, fetch, save, schema="hubspot", full=False, derived=(), update_watermarks=True, shard="all"):
+    """Sincroniza una entidad de forma incremental a partir de su watermark en sync_status.
+
+    `derived` son entidades que salen del mismo stream: tuplas (entidad, predicado, save)
+    que reciben los registros que cumplen el predicado (p. ej. leads a partir de contactos).
+    El watermark (inicio de esta corrida) solo se escribe si todos los bloques se guardaron;
+    con update_watermarks=False lo escribe quien coordina (p. ej. al terminar todos los shards).
+
+    Tras cada bloque guardado se escribe en sync_checkpoints el mayor hs_object_id confirmado
+    del shard (la búsqueda va ordenada por ID). Si hay un checkpoint pendiente, la corrida lo
+    retoma: mismo `since`, mismo inicio y solo IDs mayores al último guardado.
+    Devuelve, por entidad, los conteos de filas nuevas, actualizadas y sin cambios.
     """
+    checkpoint = get_checkpoints(entity, schema).get(shard)
+    if checkpoint and full and checkpoint["since"] is not None:
+        checkpoint = None   # una corrida --full no retoma una incremental
+    if checkpoint:
+        started, since, after_id = checkpoint["started_at"], checkpoint["since"], checkpoint["last_id"]
+    else:
+        started, since, after_id = datetime.now(timezone.utc), sync_since(entity, schema, full), None
+        if update_watermarks:
+            clear_checkpoints(entity, schema)   # restos de una corrida con otro reparto de shards
+        save_checkpoint(entity, shard, None, since, started, schema)
+    if after_id is not None:
+        logger.info(f"⏯️ {entity} [{shard}]: retomando la corrida de {started.isoformat()} "
+                    f"desde hs_object_id > {after_id}")
+    elif since:
+        logger.info(f"🔄 {entity}: sincronización incremental desde {since.isoformat()}")
+    else:
+        logger.info(f"🔄 {entity}: sincronización completa")
 
-    data = [
-        (
-            l.properties.get("hs_object_id"),
-            l.properties.get("firstname"),
-            l.properties.get("lastname"),
-            l.properties.get("email"),
-            l.properties.get("phone"),
-            l.properties.get("lifecyclestage"),
-            parse_date(l.properties.get("createdate")),
-            parse_date(l.properties.get("lastmodifieddate")),
-        )
-        for l in leads
-        if l.properties.get("hs_object_id")
-    ]
+    sinks = [(entity, None, save)] + list(derived)
+    totals = {name: {"inserted": 0, "updated": 0, "unchanged": 0} for name, _, _ in sinks}
+    pages = fetch(since=since, after_id=after_id)
+    if RAW_CACHE:
+        pages = cache_pages(cache_key(entity, schema), pages, started, since, shard=shard)
+    # Bloques (una transacción cada uno) del tamaño de lote que la tabla viene sosteniendo
+    size = batch_sizer(get_entity(entity).table, schema).size
+    chunks = iter_pipelined(pages, size=size) if SYNC_PIPELINE else iter_chunks(pages, size)
+    for records in chunks:
+        save_chunk(sinks, records, totals, schema)
+        save_checkpoint(entity, shard, max(int(r.id) for r in records), since, started, schema)
 
-    try:
-        count = bulk_insert(cursor, query, data)
+    for name, _, _ in sinks:
+        if update_watermarks:
+            update_last_sync_time(name, schema, sync_time=started)
+        logger.info(f"📊 {name}: {format_stats(totals[name])}")
+    if update_watermarks:
+        clear_checkpoints(entity, schema)
+    return totals
+
+
+def replay_entity(entity, pages, save, schema="hubspot", derived=()):
+    """Rehace la tabla de una entidad (y sus derivadas) desde páginas del cache crudo, sin la API.
+
+    No toca watermarks ni checkpoints: los datos del cache no son más nuevos que los de la base.
+    """
+    sinks = [(entity, None, save)] + list(derived)
+    totals = {name: {"inserted": 0, "updated": 0, "unchanged": 0} for name, _, _ in sinks}
+    size = batch_sizer(get_entity(entity).table, schema).size
+    chunks = iter_pipelined(pages, size=size) if SYNC_PIPELINE else iter_chunks(pages, size)
+    for records in chunks:
+        save_chunk(sinks, records, totals, schema)
+    for name, _, _ in sinks:
+        logger.info(f"📼 {name}: {format_stats(totals[name])}")
+    return totals
+
+
+# ---------- RECONCILIACIÓN DE ARCHIVADOS Y BORRADOS ----------
+def _load_ids(cursor, table, columns, pages, size=SYNC_FLUSH_SIZE):
+    """Copia a una tabla temporal las filas que llegan por páginas, de a ~size; devuelve cuántas."""
+    total = 0
+    for rows in iter_chunks(pages, size):
+        copy_rows(cursor, table, columns, rows)
+        total += len(rows)
+    return total
+
+
+def reconcile_archived(names, pages, schema="hubspot"):
+    """Marca archived_at en las tablas `names` para los objetos del listado de archivados de HubSpot.
+
+    `pages` genera listas de (hs_object_id, archived_at). Solo toca las filas de esos IDs,
+    así que no requiere recorrer el CRM completo. Devuelve {entidad: {"archived": n}}.
+    """
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMP TABLE _archived_ids (hs_object_id BIGINT, archived_at TIMESTAMPTZ) ON COMMIT DROP;
+        """)
+        received = _load_ids(cursor, "_archived_ids", ["hs_object_id", "archived_at"], pages)
+        marked = {}
+        for name in names:
+            table = get_entity(name).table
+            cursor.execute(f"""
+                UPDATE {table} t SET archived_at = a.archived_at
+                FROM _archived_ids a
+                WHERE t.hs_object_id = a.hs_object_id AND t.archived_at IS NULL
+                RETURNING t.hs_object_id;
+            """)
+            ids = [oid for (oid,) in cursor.fetchall()]
+            # Los grupos de los reportes que pierden estas filas
+            capture_keys(cursor, table, ids, schema)
+            marked[name] = {"archived": len(ids)}
+            metrics.incr(name, "rows_archived", len(ids))
         conn.commit()
-        logger.info(f"⚡ {count} leads insertados/actualizados en {schema}.leads ✅")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"❌ Error en bulk insert de leads: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    for name, stats in marked.items():
+        logger.info(f"🗃️ {name}: {stats['archived']} filas marcadas como archivadas ({received} archivados en HubSpot)")
+    return marked
 
-    logger.info(f"⏱️ Tiempo total leads: {round(time.time() - start, 2)}s")
 
+def reconcile_full(name, pages, schema="hubspot"):
+    """Compara los IDs vivos en HubSpot con la tabla de una entidad y marca/desmarca archived_at.
 
-# ---------- ENGAGEMENTS ----------
-def save_engagements_to_db(engagements, schema="hubspot"):
+    `pages` genera listas de (hs_object_id,). Los IDs se copian a una tabla temporal y la
+    diferencia se resuelve en el servidor con un anti-join, sin cargar ningún lado en memoria.
+    Si la descarga falla no se marca nada. Devuelve {"archived": n, "restored": n}.
+    """
+    table = get_entity(name).table
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE _live_ids (hs_object_id BIGINT) ON COMMIT DROP;")
+        live = _load_ids(cursor, "_live_ids", ["hs_object_id"], pages)
+        cursor.execute("ANALYZE _live_ids;")
+        cursor.execute(f"""
+            UPDATE {table} t SET archived_at = now()
+            WHERE t.archived_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM _live_ids l WHERE l.hs_object_id = t.hs_object_id);
+        """)
+        archived = cursor.rowcount
+        cursor.execute(f"""
+            UPDATE {table} t SET archived_at = NULL
+            FROM _live_ids l
+            WHERE t.hs_object_id = l.hs_object_id AND t.archived_at IS NOT NULL;
+        """)
+        restored = cursor.rowcount
+        conn.commit()
+    metrics.incr(name, "rows_archived", archived)
+    metrics.incr(name, "rows_restored", restored)
+    logger.info(f"🗃️ {name}: {live} IDs vivos en HubSpot; {archived} filas archivadas, {restored} restauradas")
+    return {"archived": archived, "restored": restored}
+
+
+# ---------- EXTRACCIÓN Y GUARDADO POR ENTIDAD ----------
+_extractors = {}
+
+
+def parse_float(value):
+    return float(value) if value else None
+
+
+def parse_int(value):
+    return int(value) if value else None
+
+
+def _field_expression(index, column):
+    getter = f"get({column.prop!r})"
+    if column.kind == "datetime":
+        # Memo por lote: cada fecha distinta se parsea una sola vez (closedate, días, etc.)
+        var = f"v{index}"
+        expression = f"(dates[{var}] if ({var} := {getter}) in dates else dates.setdefault({var}, parse_date({var})))"
+    elif column.kind == "float":
+        expression = f"parse_float({getter})"
+    elif column.kind == "int":
+        expression = f"parse_int({getter})"
+    else:
+        expression = getter
+    if column.default is not None:
+        expression = f"({expression} or defaults[{index}])"
+    return expression
+
+
+def dump_extra(values):
+    """JSON de la columna extra (claves ordenadas, así el row_hash no cambia si no cambian los valores)."""
+    return json.dumps(values, ensure_ascii=False, sort_keys=True) if values else None
+
+
+def _extra_expression(extras):
+    if extras == "all":
+        return "dump_extra({k: v for k, v in props.items() if v is not None and k not in known})"
+    return f"dump_extra({{k: v for k in {extras!r} if (v := get(k)) is not None}})"
+
+
+def compile_extractor(entity, extras=None):
+    """Genera (una vez por entidad) la función que convierte un lote de registros en tuplas.
+
+    El código se arma a partir de las columnas del registro: por fila hay una sola búsqueda
+    de atributo (`properties.get`), las conversiones quedan en línea y las fechas repetidas
+    dentro del lote se toman de un memo en vez de volver a parsearlas. Con `extras` ("all" o
+    una tupla de propiedades) cada tupla termina con el JSON de la columna extra.
+    """
+    fields = ", ".join(_field_expression(i, c) for i, c in enumerate(entity.columns))
+    if extras:
+        fields += ", " + _extra_expression(extras)
+    source = (
+        "def extract(records):\n"
+        "    dates = {}\n"
+        f"    return [({fields},)\n"
+        "            for props in (r.properties for r in records)\n"
+        "            for get in (props.get,)\n"
+        f"            if get({entity.conflict_key!r})]\n"
+    )
+    namespace = {
+        "parse_date": parse_date, "parse_float": parse_float, "parse_int": parse_int,
+        "defaults": [c.default for c in entity.columns],
+        "dump_extra": dump_extra, "known": frozenset(entity.properties),
+    }
+    exec(compile(source, f"<extractor:{entity.name}>", "exec"), namespace)
+    return namespace["extract"]
+
+
+def get_extractor(entity, extras=None):
+    key = (entity.name, extras)
+    if key not in _extractors:
+        _extractors[key] = compile_extractor(entity, extras)
+    return _extractors[key]
+
+
+def partition_months(entity, data):
+    """Meses (date del día 1, UTC) de la columna de partición presentes en un lote."""
+    index = entity.column_names.index(entity.partition_by)
+    return {
+        date(value.year, value.month, 1)
+        for value in (row[index].astimezone(timezone.utc) for row in data)
+    }
+
+
+def delete_moved_rows(cursor, entity, data):
+    """Borra las filas cuya fecha de partición cambió: el upsert las inserta en su nueva partición.
+    Corre bajo el advisory lock de la tabla que toma save_entity_to_db.
+
+    Devuelve [(clave, archived_at)] de las filas borradas, para conservar su archivado si hace falta.
+    """
+    key_index = entity.column_names.index(entity.conflict_key)
+    partition_index = entity.column_names.index(entity.partition_by)
+    cursor.execute(f"""
+        DELETE FROM {entity.table} t
+        USING unnest(%s::bigint[], %s::timestamptz[]) AS n(key, partition_value)
+        WHERE t.{entity.conflict_key} = n.key AND t.{entity.partition_by} <> n.partition_value
+        RETURNING t.{entity.conflict_key}, t.archived_at;
+    """, ([row[key_index] for row in data], [row[partition_index] for row in data]))
+    return cursor.fetchall()
+
+
+def restore_moved_archived(cursor, entity, moved):
+    """Vuelve a marcar archivadas las filas movidas de partición que lo estaban antes de moverlas."""
+    archived = [(key, archived_at) for key, archived_at in moved if archived_at is not None]
+    if archived:
+        cursor.execute(f"""
+            UPDATE {entity.table} t SET archived_at = m.archived_at
+            FROM unnest(%s::bigint[], %s::timestamptz[]) AS m(key, archived_at)
+            WHERE t.{entity.conflict_key} = m.key;
+        """, ([key for key, _ in archived], [archived_at for _, archived_at in archived]))
+
+
+def save_entity_to_db(name, records, schema="hubspot", restore_archived=True):
+    """Guarda registros de HubSpot en la tabla de la entidad; devuelve los conteos o None si falla.
+
+    Con restore_archived (lo normal al descargar de HubSpot) un registro que vuelve limpia su
+    archived_at; el replay pasa False, porque una página vieja del cache no prueba que siga vivo.
+    """
+    entity = get_entity(name)
     start = time.time()
-    conn = get_db_connection(schema=schema)
-    cursor = conn.cursor()
-
-    query = """
-        INSERT INTO engagements (hs_object_id, hs_email_direction, hs_timestamp, hs_from_email, hs_to_email, hs_subject)
-        VALUES %s
-        ON CONFLICT (hs_object_id) DO UPDATE
-        SET hs_email_direction = EXCLUDED.hs_email_direction,
-            hs_timestamp = EXCLUDED.hs_timestamp,
-            hs_from_email = EXCLUDED.hs_from_email,
-            hs_to_email = EXCLUDED.hs_to_email,
-            hs_subject = EXCLUDED.hs_subject;
+    extras = extra_property_setting(entity)
+    with metrics.timed(name, "transform"):
+        data = get_extractor(entity, extras)(records)
+    # Sin propiedades extra configuradas la columna extra no se toca
+    columns = entity.column_names + (["extra"] if extras else [])
+    update_columns = entity.update_columns + (["extra"] if extras else [])
+
+    if entity.partition_by and data:
+        # Una fila por objeto: si llegó dos veces con otra fecha (se movió), vale la última
+        data = dedupe_rows(data, columns, [entity.conflict_key])
+        ensure_month_partitions(entity, partition_months(entity, data), schema)
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        try:
+            ids = [record.id for record in records]
+            with metrics.timed(name, "db_write"):
+                if entity.partition_by:
+                    # La clave única incluye la fecha de partición: dos escritores con otra fecha para el
+                    # mismo ID no se verían entre sí y quedarían dos filas. Se serializan hasta el commit.
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"{schema}.{entity.table}",))
+                # Grupos de los reportes antes y después de escribir, para refrescarlos al final
+                capture_keys(cursor, entity.table, ids, schema)
+                moved = []
+                if entity.partition_by:
+                    moved = delete_moved_rows(cursor, entity, data)
+                    metrics.incr(name, "rows_moved", len(moved))
+                stats = upsert_rows(cursor, entity.table, columns, update_columns, data,
+                                    schema=schema, conflict_key=entity.conflict_target, restore_archived=restore_archived,
+                                    partitioned=bool(entity.partition_by))
+                if not restore_archived:
+                    restore_moved_archived(cursor, entity, moved)
+                capture_keys(cursor, entity.table, ids, schema)
+                conn.commit()
+            for key, value in stats.items():
+                metrics.incr(name, f"rows_{key}", value)
+            logger.info(f"⚡ {len(data)} {entity.label} procesados en {schema}.{entity.table} ({format_stats(stats)}) ✅")
+        except Exception as e:
+            conn.rollback()
+            stats = None
+            metrics.incr(name, "db_errors")
+            forget_hash_index(schema, entity.table)
+            logger.error(f"❌ Error en bulk insert de {entity.label}: {e}")
+
+    logger.info(f"⏱️ Tiempo total {entity.label}: {round(time.time() - start, 2)}s")
+    return stats
+
+
+ASSOCIATION_COLUMNS = ["from_type", "from_id", "to_type", "to_id", "type_id", "category", "label"]
+ASSOCIATION_KEY = "from_type, from_id, to_type, to_id, type_id"
+
+
+def delete_stale_associations(cursor, from_type, to_types, ids, rows):
+    """Borra las asociaciones de `ids` hacia `to_types` que ya no vienen en `rows`; devuelve cuántas."""
+    current = list(zip(*[(r[1], r[2], r[3], r[4]) for r in rows])) or [[], [], [], []]
+    cursor.execute("""
+        DELETE FROM associations
+        WHERE from_type = %s AND to_type = ANY(%s) AND from_id = ANY(%s)
+          AND (from_id, to_type, to_id, type_id) NOT IN (
+              SELECT * FROM unnest(%s::bigint[], %s::varchar[], %s::bigint[], %s::integer[])
+          );
+    """, (from_type, list(to_types), [int(oid) for oid in ids], *(list(values) for values in current)))
+    return cursor.rowcount
+
+
+def save_associations_to_db(name, records, fetch, schema="hubspot"):
+    """Sincroniza las asociaciones de los registros de una entidad con la tabla associations.
+
+    `fetch(from_type, to_type, ids, entity)` devuelve tuplas (from_id, to_id, type_id,
+    category, label). Las asociaciones de esos IDs que ya no existen en HubSpot se borran;
+    el resto pasa por el mismo loader (COPY o VALUES) que las entidades.
     """
+    entity = get_entity(name)
+    sink = f"{name}_associations"
+    start = time.time()
+    ids = list(dict.fromkeys(str(r.id) for r in records))
+    data = []
+    for to_type in entity.associations:
+        data.extend((entity.object_type, int(from_id), to_type, int(to_id), type_id, category, label)
+                    for from_id, to_id, type_id, category, label in fetch(entity.object_type, to_type, ids, sink))
+    data = list(dict.fromkeys(data))
 
-    data = [
-        (
-            e.properties.get("hs_object_id"),
-            e.properties.get("hs_email_direction"),
-            parse_date(e.properties.get("hs_timestamp")),
-            e.properties.get("hs_from_email"),
-            e.properties.get("hs_to_email"),
-            e.properties.get("hs_subject"),
-        )
-        for e in engagements
-        if e.properties.get("hs_object_id")
-    ]
+    with db_connection(schema) as conn, conn.cursor() as cursor:
+        try:
+            with metrics.timed(sink, "db_write"):
+                removed = delete_stale_associations(cursor, entity.object_type, entity.associations, ids, data)
+                stats = upsert_rows(cursor, "associations", ASSOCIATION_COLUMNS, ["category", "label"], data,
+                                    schema=schema, conflict_key=ASSOCIATION_KEY)
+                conn.commit()
+            for key, value in stats.items():
+                metrics.incr(sink, f"rows_{key}", value)
+            metrics.incr(sink, "rows_deleted", removed)
+            logger.info(f"🔗 {len(data)} asociaciones de {len(ids)} {entity.label} procesadas "
+                        f"({format_stats(stats)}, {removed} eliminadas) ✅")
+        except Exception as e:
+            conn.rollback()
+            stats = None
+            metrics.incr(sink, "db_errors")
+            logger.error(f"❌ Error guardando asociaciones de {entity.label}: {e}")
 
-    try:
-        count = bulk_insert(cursor, query, data)
-        conn.commit()
-        logger.info(f"⚡ {count} engagements insertados/actualizados en {schema}.engagements ✅")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"❌ Error en bulk insert de engagements: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    logger.info(f"⏱️ Tiempo total asociaciones de {entity.label}: {round(time.time() - start, 2)}s")
+    return stats
+
+
+def save_contacts_to_db(contacts, schema="hubspot"):
+    return save_entity_to_db("contacts", contacts, schema)
 
-    logger.info(f"⏱️ Tiempo total engagements: {round(time.time() - start, 2)}s")
+
+def save_deals_to_db(deals, schema="hubspot"):
+    return save_entity_to_db("deals", deals, schema)
+
+
+def save_leads_to_db(leads, schema="hubspot"):
+    return save_entity_to_db("leads", leads, schema)
+
+
+def save_engagements_to_db(engagements, schema="hubspot"):
+    return save_entity_to_db("engagements", engagements, schema)
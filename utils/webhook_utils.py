@@ -0,0 +1,245 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import metrics
+from utils.entities import root_entities
+from utils.logger import logger
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Secreto de la app de HubSpot para validar X-HubSpot-Signature-v3 (sin secreto no se valida)
+WEBHOOK_SECRET = os.getenv("HUBSPOT_WEBHOOK_SECRET")
+WEBHOOK_MAX_SKEW_SECONDS = 300
+# Debounce: se escribe cuando pasan WEBHOOK_DEBOUNCE_SECONDS sin eventos nuevos, o a lo sumo
+# WEBHOOK_MAX_DELAY_SECONDS después del primero pendiente, o al juntar WEBHOOK_FLUSH_SIZE objetos
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "2"))
+WEBHOOK_MAX_DELAY_SECONDS = float(os.getenv("WEBHOOK_MAX_DELAY_SECONDS", "15"))
+WEBHOOK_FLUSH_SIZE = int(os.getenv("WEBHOOK_FLUSH_SIZE", "1000"))
+
+# Prefijo de subscriptionType (webhooks clásicos) y objectTypeId (object.*) -> object_type
+SUBSCRIPTION_OBJECT_TYPES = {"contact": "contacts", "deal": "deals"}
+OBJECT_TYPE_IDS = {"0-1": "contacts", "0-3": "deals", "0-49": "emails"}
+
+
+def event_target(event):
+    """Entidad raíz, ID y acción ("upsert" o "delete") de un evento de webhook; None si no aplica."""
+    subscription = event.get("subscriptionType") or ""
+    prefix, _, action = subscription.partition(".")
+    object_type = OBJECT_TYPE_IDS.get(event.get("objectTypeId")) or SUBSCRIPTION_OBJECT_TYPES.get(prefix)
+    entity = next((e for e in root_entities() if e.object_type == object_type), None)
+    if entity is None or event.get("objectId") is None:
+        return None
+    kind = "delete" if action in ("deletion", "privacyDeletion") else "upsert"
+    return entity.name, str(event["objectId"]), kind
+
+
+class EventQueue:
+    """Cola en memoria de objetos pendientes por entidad, deduplicada: manda el evento más reciente
+    de cada objeto según occurredAt (una creación seguida de un borrado queda como borrado)."""
+
+    def __init__(self, debounce=WEBHOOK_DEBOUNCE_SECONDS, max_delay=WEBHOOK_MAX_DELAY_SECONDS,
+                 flush_size=WEBHOOK_FLUSH_SIZE):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.flush_size = flush_size
+        self._pending = {}          # entidad -> {objectId: (occurredAt, acción)}
+        self._first_at = None
+        self._last_at = None
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(objects) for objects in self._pending.values())
+
+    def put(self, events):
+        """Encola eventos de webhook; devuelve cuántos se aceptaron."""
+        accepted = 0
+        with self._condition:
+            for event in events:
+                target = event_target(event)
+                if target is None:
+                    continue
+                name, object_id, kind = target
+                objects = self._pending.setdefault(name, {})
+                occurred = event.get("occurredAt") or 0
+                # HubSpot no garantiza el orden de entrega
+                if object_id not in objects or occurred >= objects[object_id][0]:
+                    objects[object_id] = (occurred, kind)
+                accepted += 1
+            if accepted:
+                now = time.monotonic()
+                self._first_at = self._first_at or now
+                self._last_at = now
+                self._condition.notify()
+        return accepted
+
+    def wake(self):
+        """Despierta a quien espera en take() (p. ej. al detener el servicio)."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def _due_in(self, now):
+        if not self._pending:
+            return None
+        if sum(len(objects) for objects in self._pending.values()) >= self.flush_size:
+            return 0
+        return max(0.0, min(self._last_at + self.debounce, self._first_at + self.max_delay) - now)
+
+    def take(self, stop):
+        """Espera a que venza el debounce (o a `stop`) y devuelve lo pendiente: {entidad: {id: acción}}."""
+        with self._condition:
+            while not stop.is_set():
+                due = self._due_in(time.monotonic())
+                if due == 0:
+                    break
+                self._condition.wait(due if due is not None else 1.0)
+            pending, self._pending = self._pending, {}
+            self._first_at = self._last_at = None
+        return {name: {oid: kind for oid, (_, kind) in objects.items()} for name, objects in pending.items()}
+
+
+def valid_signature(secret, method, uri, body, timestamp, signature):
+    """Valida X-HubSpot-Signature-v3: HMAC-SHA256 en base64 de método + URI + cuerpo + timestamp."""
+    try:
+        age = time.time() - int(timestamp) / 1000
+    except (TypeError, ValueError):
+        return False
+    if abs(age) > WEBHOOK_MAX_SKEW_SECONDS or not signature:
+        return False
+    message = f"{method}{uri}".encode("utf-8") + body + str(timestamp).encode("utf-8")
+    expected = base64.b64encode(hmac.new(secret.encode("utf-8"), message, hashlib.sha256).digest()).decode()
+    return hmac.compare_digest(expected, signature)
+
+
+class WebhookService:
+    """Servicio de sync casi en tiempo real: recibe webhooks de HubSpot, los acumula en una
+    EventQueue y los escribe por lotes.
+
+    `flush(pending)` recibe {entidad: {id: acción}} y hace las lecturas batch y los upserts
+    (ver main.flush_events); corre en un solo hilo, así que los lotes no se pisan.
+    """
+
+    def __init__(self, flush, host=WEBHOOK_HOST, port=WEBHOOK_PORT, queue=None, secret=WEBHOOK_SECRET):
+        self.flush = flush
+        self.queue = queue or EventQueue()
+        self.secret = secret
+        self.stats = {"received": 0, "accepted": 0, "rejected": 0, "flushes": 0, "last_flush": None}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._terminate = threading.Event()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._flusher = threading.Thread(target=self._flush_loop, name="webhook-flush", daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _count(self, **values):
+        """Suma a los contadores de stats (los actualizan varios hilos del servidor y el flusher)."""
+        with self._stats_lock:
+            for key, value in values.items():
+                self.stats[key] = value if key == "last_flush" else self.stats[key] + value
+
+    def snapshot(self):
+        """Copia consistente de stats, más los objetos pendientes de escribir."""
+        with self._stats_lock:
+            return {**self.stats, "pending": len(self.queue)}
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if service.secret and not valid_signature(
+                    service.secret, "POST", service.request_uri(self), body,
+                    self.headers.get("X-HubSpot-Request-Timestamp"), self.headers.get("X-HubSpot-Signature-v3"),
+                ):
+                    service._count(rejected=1)
+                    return self._reply(401, {"error": "firma inválida"})
+                try:
+                    events = json.loads(body)
+                except ValueError:
+                    return self._reply(400, {"error": "JSON inválido"})
+                events = events if isinstance(events, list) else [events]
+                accepted = service.queue.put(events)
+                service._count(received=len(events), accepted=accepted)
+                metrics.incr(None, "webhook_events", len(events))
+                self._reply(202, {"accepted": accepted})
+
+            def do_GET(self):
+                if self.path != "/health":
+                    return self._reply(404, {"error": "no encontrado"})
+                self._reply(200, service.snapshot())
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload, default=str).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"🌐 webhook {self.address_string()} {format % args}")
+
+        return Handler
+
+    def request_uri(self, handler):
+        """URI completa con la que HubSpot firmó el request (detrás de un proxy, usa X-Forwarded-*)."""
+        proto = handler.headers.get("X-Forwarded-Proto", "http")
+        host = handler.headers.get("X-Forwarded-Host") or handler.headers.get("Host", "")
+        return f"{proto}://{host}{handler.path}"
+
+    def _flush_loop(self):
+        while not self._stop.is_set() or len(self.queue):
+            pending = self.queue.take(self._stop)
+            if not pending:
+                continue
+            try:
+                with metrics.timed(None, "webhook_flush"):
+                    self.flush(pending)
+            except Exception as e:
+                # Lo no escrito lo recupera la próxima sync incremental (el watermark no se toca)
+                metrics.incr(None, "webhook_flush_errors")
+                logger.error(f"❌ Error escribiendo eventos de webhook: {e}")
+            self._count(flushes=1, last_flush=datetime.now(timezone.utc).isoformat())
+
+    def start(self):
+        self._flusher.start()
+        threading.Thread(target=self._server.serve_forever, name="webhook-http", daemon=True).start()
+        host, port = self.address
+        logger.info(f"🌐 Escuchando webhooks de HubSpot en http://{host}:{port}")
+
+    def stop(self):
+        """Deja de recibir, escribe lo pendiente y termina."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._stop.set()
+        self.queue.wake()
+        self._flusher.join()
+
+    def serve_forever(self):
+        """Atiende hasta Ctrl-C o SIGTERM (systemd, docker stop); en los dos casos escribe lo
+        pendiente antes de volver, porque esos eventos ya se le confirmaron a HubSpot."""
+        previous = None
+        if threading.current_thread() is threading.main_thread():
+            previous = signal.signal(signal.SIGTERM, lambda signum, frame: self._terminate.set())
+        self.start()
+        try:
+            while not self._terminate.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("🛑 Deteniendo el servicio de webhooks...")
+            self.stop()
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)